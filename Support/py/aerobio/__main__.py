@@ -9,15 +9,21 @@ else:
 import getpass
 import getopt, sys
 
-import warnings
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore", category=DeprecationWarning)
-    import pkg_resources
-
+import random
 import time
-import trio
-import client as cli
-from client import close, error, bpwait, bpresume, sent, stop, rmv
+from collections import deque
+import keywords as kw
+from keywords import close, error, bpwait, bpresume, sent, stop, end, rmv
+
+# trio and the client (and with it trio_websocket and msgpack) take most
+# of the startup time, so they are only imported, by import_client, once
+# there is a command to send: printing the usage or rejecting bad
+# arguments doesn't wait for them.
+
+def import_client ():
+    global trio, cli
+    import trio
+    import client as cli
 
 udb = {}
 
@@ -32,22 +38,25 @@ dsdict = lambda dict, *keys: list((dict[key] for key in keys))
 
 
 def appmsg (ws, data):
-    op, payload = dsdict(data, cli.op, cli.payload)
-    if op == cli.keyword('validate'):
+    op, payload = dsdict(data, kw.op, kw.payload)
+    if op == kw.keyword('validate'):
         print("")
         print(payload)
-    elif op == cli.keyword("error"):
+    elif op == kw.keyword("error"):
         print("")
         if ("Error" == payload[0:5]):
             print(payload)
         else:
             print("Error :", payload)
-    elif op == cli.keyword("launch"):
+    elif op == kw.keyword("launch"):
         print("")
         print("Job launch: ", payload)
-    elif op == cli.keyword('status'):
-        print(payload)
-    elif op == cli.keyword('register'):
+    elif op == kw.keyword('status'):
+        if 'watch' in udb:
+            render_status(payload)
+        else:
+            print(payload)
+    elif op == kw.keyword('register'):
         update_udb(['register'], payload)
     else:
         print("UOP:", op, "\nUPAYLOAD", payload)
@@ -55,18 +64,20 @@ def appmsg (ws, data):
 def dispatcher (ch, op, payload):
     #print("DISPATCH:", op, payload)
 
-    if op == cli.msg or op == 'msg':
+    if op == kw.msg or op == 'msg':
         ws, data = dsdict(payload, 'ws', 'data')
         #print('CLIENT :msg/payload = ', payload)
         update_udb([ws, 'lastrcv'], data)
         update_udb([ws, 'rcvcnt'], get_udb([ws, 'rcvcnt'])+1)
+        if 'batch' in udb:
+            batch_header()
         appmsg(ws, data)
-    elif op == cli.sent:
-        ws, msg = dsdict(payload, 'ws', cli.msg)
+    elif op == kw.sent:
+        ws, msg = dsdict(payload, 'ws', kw.msg)
         #print("CLIENT, Sent msg ", msg)
         update_udb([ws, 'lastsnt'], msg)
         update_udb([ws, 'sntcnt'], get_udb([ws, 'sntcnt'])+1)
-    elif op == cli.open:
+    elif op == kw.open:
         ws = payload
         #print("CLIENT :open/ws = ", ws)
         update_udb([ws], {'chan': ch, 'rcvcnt': 0, 'sntcnt': 0, 'errcnt': 0})
@@ -79,19 +90,24 @@ def dispatcher (ch, op, payload):
         print("CLIENT :error/payload = ", payload)
         update_udb([ws, 'errcnt'], get_udb([ws, 'errcnt'])+1)
     elif op == bpwait:
-        ws, msg, encode = dsdict(payload, 'ws', cli.msg, 'encode')
-        print("CLIENT, Waiting to send msg ", msg)
-        v = udb["bpwait"] if "bpwait" in udb else []
-        v.append([ws, msg, encode])
-        update_udb(["bpwait"], v)
-        time.sleep(0.1)
+        # watch and batch cross the backpressure window as a matter of
+        # course, so only a single command reports it
+        ws, msg, encode = dsdict(payload, 'ws', kw.msg, 'encode')
+        if 'batch' not in udb and 'watch' not in udb:
+            print("CLIENT, Waiting to send msg ", msg)
     elif op == bpresume:
-        print("CLIENT, BP Resume ", payload)
-        update_udb(["resume"], payload)
+        if 'batch' not in udb and 'watch' not in udb:
+            print("CLIENT, BP Resume ", payload)
+    elif op == end:
+        if 'batch' in udb:
+            batch_end()
     elif op == stop:
+        # The connection is done, drop what was kept for it
         ws, cause = dsdict(payload, 'ws', 'cause')
-        print("CLIENT, Stopping reads... Cause ", cause)
-        update_udb([ws], rmv)
+        if ws in udb:
+            update_udb([ws], rmv)
+        if 'com' in udb and udb['com'][1] is ws:
+            update_udb(['com'], rmv)
     else:
         print("CLIENT :WTF/op = ", op, " payload = ", payload)
 
@@ -99,33 +115,34 @@ def dispatcher (ch, op, payload):
 
 # msg attributes as keywords
 #
-kwcmd = cli.keyword("cmd")
-kwuser = cli.keyword("user")
-kwphase = cli.keyword("phase")
-kwaction = cli.keyword("action")
-kwargs = cli.keyword("args")
-kwmodifier = cli.keyword("modifier")
-kweid = cli.keyword("eid")
-kwcompfile = cli.keyword("compfile")
+kwcmd = kw.keyword("cmd")
+kwuser = kw.keyword("user")
+kwphase = kw.keyword("phase")
+kwaction = kw.keyword("action")
+kwargs = kw.keyword("args")
+kwmodifier = kw.keyword("modifier")
+kweid = kw.keyword("eid")
+kwcompfile = kw.keyword("compfile")
+kwinterval = kw.keyword("interval")
 
 def getarg (arglist):
     arg = arglist[0]
     arglist = arglist[1:]
     return (arg, arglist)
 
-def args2map ():
+def args2map (arglist=None):
     user = getpass.getuser()
     argmap = {kwuser: user}
-    fullArgs = sys.argv
-    arglist = fullArgs[1:]
+    if arglist is None:
+        arglist = sys.argv[1:]
 
     if (len(arglist) < 1):
-        print(pkg_resources.resource_string(
-            __name__, "resources/usage.txt").decode("utf-8").strip())
+        from importlib.resources import files
+        print(files("resources").joinpath("usage.txt").read_text().strip())
         sys.exit()
 
     (cmd,arglist) = getarg(arglist)
-    argmap[kwcmd] = cli.keyword(cmd)
+    argmap[kwcmd] = kw.keyword(cmd)
 
     if cmd == 'run':
         (phase,arglist) = getarg(arglist)
@@ -145,11 +162,13 @@ def args2map ():
         argmap[kwcompfile] = compfile
         (eid, arglist) = getarg(arglist)
         argmap[kweid] = eid
-    elif (cmd == 'status'):
+    elif (cmd == 'status') or (cmd == 'watch'):
         (action,arglist) = getarg(arglist)
         argmap[kwaction] = action
         (eid,arglist) = getarg(arglist)
         argmap[kweid] = eid
+        if (cmd == 'watch'):
+            argmap[kwinterval] = float(arglist[0]) if arglist else 10.0
     elif (cmd == 'check'):
         (eid,arglist) = getarg(arglist)
         argmap[kweid] = eid
@@ -164,19 +183,23 @@ def args2map ():
     return argmap
 
 
-def get_port ():
-    if pwd:
-        # Linux/Mac
-        users = map(lambda x: x[0], pwd.getpwall())
-    else:
+def aerobio_user ():
+    if not pwd:
         # Windows, just give up
-        users = []
+        return False
+    try:
+        pwd.getpwnam("aerobio")
+        return True
+    except KeyError:
+        return False
+
+def get_port ():
     curuser = getpass.getuser()
     hmdir = os.path.expanduser("~{0}".format(curuser))
 
     if os.path.isdir(os.path.join(hmdir, ".aerobio")):
         portfile = os.path.join(hmdir, ".aerobio", ".ports")
-    elif "aerobio" in users:
+    elif aerobio_user():
         hmdir = os.path.expanduser("~aerobio")
         portfile = os.path.join(hmdir, ".aerobio", ".ports")
     else:
@@ -199,30 +222,150 @@ def get_port ():
 
 
 
-async def bpretry ():
-    return "bpwait" in udb and udb["bpwait"]
-
-async def resume ():
-    while "resume" not in udb:
-        await trio.sleep(0.1)
-    return True
-
 async def command (info):
-    while not 'com' in udb:
-        time.sleep(0.1)
     ws = info["ws"]
+    if not await cli.wait_ready(ws):
+        return
     argmap = info["appinfo"]["argmap"]
     await cli.send_msg(
-        ws, {cli.op: argmap[kwcmd], cli.keyword('data'): argmap})
+        ws, {kw.op: argmap[kwcmd], kw.keyword('data'): argmap})
+
+
+# watch: follows a job's status over one persistent connection,
+# re-requesting it every interval seconds and printing it only when it
+# has changed. If the connection fails or the server goes away, it
+# reconnects after a backoff doubling from WATCH_BACKOFF[0] up to
+# WATCH_BACKOFF[1] seconds (reset once a connection is made), with
+# random jitter so many watchers don't all reconnect at once.
+
+WATCH_BACKOFF = (1, 60)
+
+def render_status (payload):
+    if payload != udb['watch']:
+        update_udb(['watch'], payload)
+        print("----", time.strftime("%Y-%m-%d %H:%M:%S"), "----")
+        print(payload)
+
+async def watch (info):
+    ws = info["ws"]
+    if not await cli.wait_ready(ws):
+        return
+    update_udb(['backoff'], WATCH_BACKOFF[0])
+    argmap = info["appinfo"]["argmap"]
+    request = {k: v for k, v in argmap.items() if k != kwinterval}
+    request[kwcmd] = kw.keyword('status')
+    while True:
+        if not await cli.request(
+                ws, {kw.op: request[kwcmd], kw.keyword('data'): request}):
+            return
+        # Sleeps the interval, but wakes at once if the connection goes
+        with trio.move_on_after(argmap[kwinterval]):
+            if not await cli.wait_end(ws):
+                return
+
+async def watch_loop (url, argmap):
+    update_udb(['watch'], None)
+    update_udb(['backoff'], WATCH_BACKOFF[0])
+    while True:
+        try:
+            await cli.open_connection(url, dispatcher, watch,
+                                      {"argmap": argmap}, persist=True)
+        except Exception as e:
+            print("Connection failed:", e)
+        delay = get_udb(['backoff'])
+        update_udb(['backoff'], min(2 * delay, WATCH_BACKOFF[1]))
+        wait = random.uniform(delay / 2, delay)
+        print("Reconnecting in {0:.1f}s".format(wait))
+        await trio.sleep(wait)
+
+
+# batch: runs many commands over one connection. The commands are read
+# from a file (or stdin, for - or no file), one per line in the same
+# form as on the command line; blank lines and lines starting with '#'
+# are skipped. The server handles each message concurrently and its
+# replies carry no eid or request id, so replies to commands sent
+# together could come back in any order. Each command is sent only
+# once the reply to the one before has ended (with its stop), which
+# ties every reply to its command; it is printed under a "==== command"
+# line. udb['batch'] holds the commands not yet answered (see run_batch).
+
+def read_batch (fname):
+    fp = sys.stdin if fname == "-" else open(fname)
+    commands = []
+    with fp:
+        for line in fp:
+            args = line.split()
+            if not args or args[0].startswith('#'):
+                continue
+            if args[0] in ('batch', 'watch'):
+                sys.exit("Not a batch command: " + line.strip())
+            try:
+                commands.append((" ".join(args), args2map(args)))
+            except IndexError:
+                sys.exit("Missing arguments in batch command: " + line.strip())
+    return commands
+
+def batch_header ():
+    if not udb['batchhead'] and udb['batch']:
+        update_udb(['batchhead'], True)
+        print("====", udb['batch'][0])
+
+def batch_end ():
+    batch_header()
+    if udb['batch']:
+        udb['batch'].popleft()
+    update_udb(['batchhead'], False)
+
+async def batch (info):
+    ws = info["ws"]
+    if not await cli.wait_ready(ws):
+        return
+    for line, argmap in info["appinfo"]["commands"]:
+        if not await cli.request(
+                ws, {kw.op: argmap[kwcmd], kw.keyword('data'): argmap}):
+            return
+    await cli.disconnect(ws)
+
+# All the commands are queued before connecting, so any left without a
+# reply - including every one of them when the connection can't be made
+# or goes before the server is ready - is listed, with exit status 1.
+
+def run_batch (url, commands):
+    update_udb(['batch'], deque(line for line, argmap in commands))
+    update_udb(['batchhead'], False)
+    if commands:
+        try:
+            trio.run(cli.open_connection, url, dispatcher, batch,
+                     {"commands": commands}, True)
+        except (OSError, cli.tws.HandshakeError) as e:
+            print("Connection failed:", e)
+    if udb['batch']:
+        print("No reply for:")
+        for line in udb['batch']:
+            print("  " + line)
+        sys.exit(1)
 
 
 def main():
     ## print("Hello from Aerobio Python")
+    if sys.argv[1:2] == ['batch']:
+        commands = read_batch(sys.argv[2] if len(sys.argv) > 2 else "-")
+        url = 'ws://localhost:' + get_port() + '/ws'
+        import_client()
+        run_batch(url, commands)
+        return
     argmap = args2map()
     #print("ArgMap:", argmap)
     url = 'ws://localhost:' + get_port() + '/ws'
-    trio.run(cli.open_connection,
-             url, dispatcher, command, {"argmap": argmap})
+    import_client()
+    if argmap[kwcmd] == kw.keyword('watch'):
+        try:
+            trio.run(watch_loop, url, argmap)
+        except KeyboardInterrupt:
+            pass
+    else:
+        trio.run(cli.open_connection,
+                 url, dispatcher, command, {"argmap": argmap})
 
 
 if __name__ == "__main__":
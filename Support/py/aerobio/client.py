@@ -4,24 +4,14 @@ from trio_websocket import open_websocket_url, connect_websocket_url
 
 import msgpack
 import json
+from collections import deque
 
 import channels
 from channels import chan, put, take
+from keywords import keyword, op, set, reset, payload, msgrcv, msgsnt, \
+    bpsize, open, close, msg, bpwait, bpresume, sent, error, stop, end, rmv
 
 
-class keyword:
-    val = None
-    def __init__(self, val):
-        self.val = val
-    def __eq__(self, x):
-        return type(x) is keyword and self.val == x.val
-    def __hash__(self):
-        return hash(self.val)
-    def __str__(self):
-        return ":" + self.val
-    def __repr__(self):
-        return ":" + self.val
-
 def default(obj):
     if type(obj) is keyword:
         pks = msgpack.packb(obj.val, default=default, use_bin_type=True)
@@ -36,25 +26,30 @@ def ext_hook(code, data):
     return msgpack.ExtType(code, data)
 
 
-## Envelope keys
-op = keyword("op")
-set = keyword("set")
-reset = keyword("reset")
-payload = keyword("payload")
-msgrcv = keyword("msgrcv")
-msgsnt = keyword("msgsnt")
-bpsize = keyword("bpsize")
-## operators
-open = keyword("open")
-close = keyword("close")
-msg = keyword("msg")
-bpwait = keyword("bpwait")
-bpresume = keyword("bpresume")
-sent = keyword("sent")
-error = keyword("error")
-stop = keyword("stop")
-
-rmv = keyword("rmv")
+## The state of one connection. cli_db maps the websocket of each open
+## connection to its Connection, from connect until open_connection
+## returns, when the entry is dropped along with anything still queued.
+
+class Connection:
+    __slots__ = ("url", "ws", "chan", "persist",
+                 "bpsize", "msgrcv", "msgsnt", "bpqueue",
+                 "ready", "resume", "end", "closed", "closing")
+
+    def __init__ (self, url, ws, ch, persist):
+        self.url = url
+        self.ws = ws
+        self.chan = ch
+        self.persist = persist
+        self.bpsize = 0
+        self.msgrcv = 0
+        self.msgsnt = 0
+        self.bpqueue = deque()
+        self.ready = trio.Event()
+        self.resume = trio.Event()
+        self.end = trio.Event()
+        self.closed = False
+        self.closing = False
+
 cli_db = {}
 
 def get_db(x,keys):
@@ -101,6 +96,7 @@ async def goloop (ch, dispatchfn):
         mop = get_msg_op(msg)
         mpload = get_msg_payload(msg)
         if mop == stop or mop == "stop":
+            dispatchfn(ch, mop, mpload)
             break
         elif mop == 'no_op':
             print("WARNING Recv: bad msg envelope no 'op' field: ", msg)
@@ -108,6 +104,8 @@ async def goloop (ch, dispatchfn):
             print("WARNING Recv: bad msg envelope no 'payload' field: ", msg)
         else:
             dispatchfn(ch, mop, mpload)
+            if mop == end:
+                signal(cli_db[mpload["ws"]], "end")
     #print("GOLOOP exit")
 
 
@@ -121,122 +119,217 @@ async def send (ws, enc, msg):
         encmsg = json.dumps(msg)
     await ws.send_message(encmsg)
 
+## Backpressure: at most bpsize messages are sent before the server
+## resets the count. Messages sent past that, or while earlier ones are
+## still waiting, are queued in order on the connection's bpqueue (and
+## a bpwait dispatched for each), then replayed as soon as a set or
+## reset opens the window again. The queue holds at most bpqueue_size
+## messages; beyond that send_msg waits for a reset to make room. Once
+## the connection has gone send_msg drops the message.
+
+bpqueue_size = 1000
+
 async def send_msg(ws, msg, encode="binary"):
     kwmsg = keyword("msg")
-    msntcnt = get_db(cli_db, [ws, msgsnt])
-    ch = get_db(cli_db, [ws, "chan"])
-    if msntcnt >= get_db(cli_db, [ws, bpsize]):
-        await put(ch, {op: bpwait,
-                       payload: {"ws": ws, kwmsg: msg, "encode": encode,
-                                 msgsnt: msntcnt}})
+    conn = cli_db[ws]
+    while len(conn.bpqueue) >= bpqueue_size and not conn.closed:
+        await conn.resume.wait()
+    if conn.closed:
+        return
+    if conn.bpqueue or conn.msgsnt >= conn.bpsize:
+        conn.bpqueue.append((msg, encode))
+        await put(conn.chan,
+                  {op: bpwait,
+                   payload: {"ws": ws, kwmsg: msg, "encode": encode,
+                             msgsnt: conn.msgsnt}})
     else:
-        hmsg = {op: kwmsg, payload: msg}
-        await send(ws, encode, hmsg)
-        update_db(cli_db, [ws, msgsnt], msntcnt+1)
-        await put(ch, {op: sent,
-                       payload: {"ws": ws, kwmsg: hmsg,
-                                 msgsnt: get_db(cli_db, [ws, msgsnt])}})
+        await send_window(conn, msg, encode)
+
+async def send_window (conn, msg, encode):
+    kwmsg = keyword("msg")
+    hmsg = {op: kwmsg, payload: msg}
+    await send(conn.ws, encode, hmsg)
+    conn.msgsnt += 1
+    await put(conn.chan,
+              {op: sent,
+               payload: {"ws": conn.ws, kwmsg: hmsg, msgsnt: conn.msgsnt}})
+
+async def replay (conn):
+    queue = conn.bpqueue
+    while queue and conn.msgsnt < conn.bpsize:
+        msg, encode = queue.popleft()
+        await send_window(conn, msg, encode)
+
+
+## Connection ready and backpressure resume signalling. ready is set
+## once the server's set message has given the window size, resume
+## each time a reset reopens it (and is then replaced by a fresh Event
+## for the next wait - send_msg waits on it when the bpqueue is full).
+## On a persistent connection end is set, and replaced, each time the
+## server stops a reply - once the reply's messages have been
+## dispatched, as the end comes through the channel after them. All are
+## set when the connection goes, so no waiter is left hanging; the
+## waits then return False.
+
+async def wait_ready (ws):
+    conn = cli_db[ws]
+    await conn.ready.wait()
+    return not conn.closed
+
+async def wait_end (ws):
+    conn = cli_db[ws]
+    await conn.end.wait()
+    return not conn.closed
+
+## Sends msg on a persistent connection and waits for the end of the
+## reply, False if the connection went instead. The end Event is taken
+## before sending, as the whole reply may arrive while sending.
+
+async def request (ws, msg, encode="binary"):
+    conn = cli_db[ws]
+    end = conn.end
+    await send_msg(ws, msg, encode)
+    await end.wait()
+    return not conn.closed
+
+def signal (conn, name):
+    event = getattr(conn, name)
+    setattr(conn, name, trio.Event())
+    event.set()
+
+def signal_closed (conn):
+    conn.closed = True
+    conn.bpqueue.clear()
+    conn.ready.set()
+    conn.resume.set()
+    conn.end.set()
 
 
 async def receive (ws, msg):
     kwmsg = keyword("msg")
+    conn = cli_db[ws]
     mop = get_msg_op(msg)
     if mop == set:
         #print("INIT MSG: ", msg)
-        mbpsize = msg[payload][bpsize]
-        mmsgrcv = msg[payload][msgrcv]
-        update_db(cli_db, [ws, msgrcv], mmsgrcv)
-        update_db(cli_db, [ws, bpsize], mbpsize)
+        conn.msgrcv = msg[payload][msgrcv]
+        conn.bpsize = msg[payload][bpsize]
+        conn.ready.set()
+        await replay(conn)
     elif mop == reset:
-        update_db(cli_db, [ws, msgsnt], msg[payload][msgsnt])
-        ch = get_db(cli_db, [ws, "chan"])
-        await put(ch, {op: bpresume, payload: msg})
+        conn.msgsnt = msg[payload][msgsnt]
+        await replay(conn)
+        signal(conn, "resume")
+        await put(conn.chan, {op: bpresume, payload: msg})
     elif mop == "msg" or mop == kwmsg:
-        rcvd = get_db(cli_db, [ws, msgrcv])
         data = get_msg_payload(msg)
-        if rcvd+1 >= get_db(cli_db, [ws, bpsize]):
-            update_db(cli_db, [ws, msgrcv], 0)
+        if conn.msgrcv+1 >= conn.bpsize:
+            conn.msgrcv = 0
             await send(ws, "binary", {op: reset, payload: {msgsnt: 0}})
         else:
-            update_db(cli_db, [ws, msgrcv], get_db(cli_db, [ws, msgrcv])+1)
-        ch = get_db(cli_db, [ws, "chan"])
-        await put(ch, {op: kwmsg, payload: {"ws": ws, "data": data}})
+            conn.msgrcv += 1
+        await put(conn.chan, {op: kwmsg, payload: {"ws": ws, "data": data}})
     else:
         print("Client Receive Handler - unknown OP ", msg)
 
 
+## Returns the next message, or stop once the connection has closed or
+## failed.
+
 async def read_line (ws):
     try:
         msg = await ws.get_message()
-        msg = msgpack.unpackb(msg, ext_hook=ext_hook, raw=False, strict_map_key=False)
-        update_db(cli_db, ['msg'], msg)
+        return msgpack.unpackb(msg, ext_hook=ext_hook, raw=False, strict_map_key=False)
     except tws.ConnectionClosed as e:
-        await rmtclose(ws,e)
-        update_db(cli_db, ['msg'], stop)
+        if not cli_db[ws].closing:
+            await rmtclose(ws,e)
     except Exception as e:
         await onerror(ws,e)
-        update_db(cli_db, ['msg'], stop)
+    return stop
+
+## However it ends, the connection's waiters are released, the
+## websocket is closed and a stop, with the ws and the cause, is the
+## last thing dispatched for it.
 
 async def line_loop (ws):
     #print("Line loop called ...")
-    while True:
-        try:
-            await read_line(ws)
-            msg = get_db(cli_db, ['msg'])
-            #print("MSG: ", msg)
-            mop = get_msg_op(msg)
-            if mop == "stop" or mop == keyword("stop"):
-                ch = get_db(cli_db, [ws, "chan"])
-                await put(ch, {op: stop, payload: {}})
-                await ws.aclose()
+    conn = cli_db[ws]
+    cause = "closed"
+    try:
+        while True:
+            try:
+                msg = await read_line(ws)
+                if msg == stop:
+                    break
+                #print("MSG: ", msg)
+                mop = get_msg_op(msg)
+                if (mop == "stop" or mop == keyword("stop")) and conn.persist:
+                    # The end of one reply, the connection stays open
+                    await put(conn.chan, {op: end, payload: {"ws": ws}})
+                elif mop == "stop" or mop == keyword("stop"):
+                    cause = "stop"
+                    break
+                else:
+                    await receive(ws, msg)
+            except Exception as e:
+                await onerror(ws,e)
+                cause = "error"
                 break
-            else:
-                await receive(ws, msg)
-        except Exception as e:
-            await onerror(ws,e)
-            break
+    finally:
+        signal_closed(conn)
+        await ws.aclose()
+        await put(conn.chan, {op: stop, payload: {"ws": ws, "cause": cause}})
     #print("Line LOOP exit")
 
 
 async def rmtclose (ws, e):
-    ch = get_db(cli_db, [ws, "chan"])
     print("Close: {0}".format(e))
-    await put(ch, {op: close, payload: {"code": e.code, "reason": e.reason}})
+    await put(cli_db[ws].chan,
+              {op: close, payload: {"ws": ws, "code": e.reason.code,
+                                    "reason": e.reason.reason}})
 
 async def onerror (ws, e):
-    ch = get_db(cli_db, [ws, "chan"])
     print("Error: ", e)
-    await put(ch, {op: error, payload: {"ws": ws, "err": e}})
+    await put(cli_db[ws].chan, {op: error, payload: {"ws": ws, "err": e}})
 
 
 
 
+## A server stop message normally ends the connection. A persistent
+## connection (persist=True) instead takes it as the end of a reply,
+## signalled through wait_end, and keeps reading, so one connection can
+## carry many requests. disconnect closes it from this end.
+
 # 'ws://localhost:8765/ws'
-async def connect (url, nursery):
+async def connect (url, nursery, persist=False):
     ws = await connect_websocket_url(nursery, url, message_queue_size=10)
     ch = chan(19)
-    chrec = {"url": url, "ws": ws, "chan": ch,
-             bpsize: 0, msgrcv: 0, msgsnt: 0}
-    update_db(cli_db, ["ws"], ws)
-    update_db(cli_db, [ch], chrec)
-    update_db(cli_db, [ws], chrec)
-    update_db(cli_db, [ws, "chan"], ch)
+    conn = Connection(url, ws, ch, persist)
+    cli_db[ws] = conn
     await put(ch, {op: open, payload: ws})
-    return chrec
-
-async def open_connection (url, dispatchfn, apptask=None, appinfo={}):
-    async with trio.open_nursery() as nursery:
-        chrec = await connect(url, nursery)
-        ch = chrec["chan"]
-        ws = get_db(cli_db, [ch, 'ws'])
-        nursery.start_soon(line_loop, ws)
-        nursery.start_soon(goloop, ch, dispatchfn)
-        await trio.sleep(0.1)
-        if apptask != None:
-            info = {"nursery": nursery, "chrec": chrec,
-                    "ws": ws, "db": cli_db,
-                    "appinfo": appinfo}
-            nursery.start_soon(apptask, info)
+    return conn
+
+async def disconnect (ws):
+    cli_db[ws].closing = True
+    await ws.aclose()
+
+async def open_connection (url, dispatchfn, apptask=None, appinfo={},
+                           persist=False):
+    conn = None
+    try:
+        async with trio.open_nursery() as nursery:
+            conn = await connect(url, nursery, persist)
+            ws = conn.ws
+            nursery.start_soon(line_loop, ws)
+            nursery.start_soon(goloop, conn.chan, dispatchfn)
+            if apptask != None:
+                info = {"nursery": nursery, "conn": conn,
+                        "ws": ws, "db": cli_db,
+                        "appinfo": appinfo}
+                nursery.start_soon(apptask, info)
+    finally:
+        if conn is not None:
+            conn.bpqueue.clear()
+            cli_db.pop(conn.ws, None)
 
 
 async def main():
@@ -0,0 +1,38 @@
+## The keyword type, which msgpacks as a Clojure keyword, and the
+## message envelope keywords. These need nothing beyond Python itself,
+## so the command line can be parsed without loading the client.
+
+class keyword:
+    val = None
+    def __init__(self, val):
+        self.val = val
+    def __eq__(self, x):
+        return type(x) is keyword and self.val == x.val
+    def __hash__(self):
+        return hash(self.val)
+    def __str__(self):
+        return ":" + self.val
+    def __repr__(self):
+        return ":" + self.val
+
+
+## Envelope keys
+op = keyword("op")
+set = keyword("set")
+reset = keyword("reset")
+payload = keyword("payload")
+msgrcv = keyword("msgrcv")
+msgsnt = keyword("msgsnt")
+bpsize = keyword("bpsize")
+## operators
+open = keyword("open")
+close = keyword("close")
+msg = keyword("msg")
+bpwait = keyword("bpwait")
+bpresume = keyword("bpresume")
+sent = keyword("sent")
+error = keyword("error")
+stop = keyword("stop")
+end = keyword("end")
+
+rmv = keyword("rmv")
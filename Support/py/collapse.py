@@ -1,13 +1,35 @@
 
+import io
+import os
+import sys
+import glob
 import os.path
 import gzip
+import heapq
+import queue
+import shutil
 import argparse
+import itertools
+import tempfile
+import subprocess
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-fqzin", action="store", dest="fqz")
 parser.add_argument("-fqin", action="store", dest="fq")
 parser.add_argument("-faot", action="store", dest="fa")
+parser.add_argument("-jobs", action="store", dest="jobs")
+parser.add_argument("-shards", action="store", dest="shards")
+parser.add_argument("-mem", action="store", dest="mem")
+parser.add_argument("-tmp", action="store", dest="tmp")
+parser.add_argument("-unzip", action="store", dest="unzip")
+parser.add_argument("-zip", action="store", dest="zip")
+parser.add_argument("-order", action="store", dest="order")
+parser.add_argument("-umi", action="store", dest="umi")
+parser.add_argument("-qual", action="store", dest="qual")
 arguments = parser.parse_args()
 
 
@@ -15,46 +37,368 @@ def print_usage():
     print("\n" + "You are missing one or more required flags." +"\n\n")
     print("-fqin for uncompressed fastq input or -fqzin for compressed.")
     print("-faot for the collapsed fasta output file.")
+    print("-jobs for the number of worker processes counting blocks of reads (default 1).")
+    print("-shards for the number of shards the sequences are hashed into (default 16).")
+    print("-mem for the memory budget, in MB, of the merged counts before they spill to disk (default 2000).")
+    print("-tmp for the directory of spilled shards (default the directory of -faot).")
+    print("-unzip for how -fqzin is decompressed: pigz, gzip or python (default the first of those found).")
+    print("-zip for how a -faot ending in .gz is compressed: pigz, gzip or python (default the first of those found).")
+    print("-order for the order of the fasta: first (occurrence, the default) or count (descending).")
+    print("-umi for the start:end slice of the read header (after the @) holding its UMI; reads are then")
+    print("     collapsed by sequence and UMI, a sequence counting its distinct UMIs, so PCR duplicates are dropped.")
+    print("     Slices from the end of the header are given as e.g. -umi=-8: (negative start).")
+    print("-qual for each sequence's phred quality in its header, as i-count-phred: mean or max over its reads.")
 
 if ((not arguments.fq and not arguments.fqz) or not arguments.fa):
     print_usage()
     quit()
 
+jobs = int(arguments.jobs) if arguments.jobs else 1
+shards = int(arguments.shards) if arguments.shards else 16
+budget = (int(arguments.mem) if arguments.mem else 2000) * 1024 * 1024
+scratch_dir = arguments.tmp or os.path.dirname(os.path.abspath(arguments.fa))
+order = arguments.order or "first"
+if order not in ("first", "count"):
+    sys.exit("Unknown -order: " + order)
 
-def read_fqrec(infq):
-    hd = infq.readline()
-    if not hd:
-        return []
-    sq = infq.readline()
-    aux = infq.readline()
-    phred = infq.readline()
-    return [hd,sq,aux,phred]
+umi = None
+if arguments.umi:
+    try:
+        umi = slice(*[int(i) if i else None for i in arguments.umi.split(":")])
+    except (ValueError, TypeError):
+        sys.exit("Bad -umi, need start:end: " + arguments.umi)
+qual = arguments.qual
+if qual not in (None, "mean", "max"):
+    sys.exit("Unknown -qual: " + qual)
 
 
-sqM = {}
+# Reads are counted a block of block_records records at a time. With
+# -jobs above 1 the blocks are dealt round robin to that many worker
+# processes, each keeping its own running counts, so the main process
+# only reads. Whenever a worker's counts outgrow its share of the -mem
+# budget they are spilled - split into -shards shards by the hash of
+# the sequence - to shard files in a scratch directory under -tmp, and
+# counting starts over. At the end the shard files are merged a shard
+# at a time (again over -jobs processes), and the shards into the
+# collapsed fasta. So memory is bounded by the budget plus one shard's
+# distinct sequences; -shards needs to be large enough for one shard
+# to fit. A single process that never spills writes its counts
+# straight out.
+#
+# Each distinct sequence carries where it first occurred - the block
+# it was first seen in and its rank among the counts, packed in one
+# int - and by default the fasta is written in that order. That's the
+# order of collapsing into a single dictionary, whatever the jobs,
+# shards and budget, so the output is deterministic. With -order count
+# the most abundant sequences come first, ties in first occurrence
+# order.
+#
+# With -umi, what is counted is each read's UMI and sequence, as one
+# "umi<tab>sequence" key, and a sequence's count is then the number of
+# distinct UMIs it was read with - reads sharing both being PCR
+# duplicates. With -qual, the sum of each read's quality line is kept
+# too, summed (mean) or maxed (max) over the reads of each key: one int
+# per key, from which the mean phred of the sequence's reads, or that
+# of its best read, is worked out when it is written. Reads of the
+# same sequence have the same length, so the one sum is enough. Shards
+# are by sequence, so all of a sequence's keys end up in the same one.
 
-if arguments.fq:
-    infq = open(arguments.fq, "r")
-else:
-    infq = gzip.open(arguments.fqz, "rt")
+block_records = 100000
 
-with open(arguments.fa, 'w') as otfa:
+# Rough size of a counted sequence on top of its characters: its
+# dictionary slot, the count and the string object, and with -qual its
+# quality sum.
+entry_overhead = 250 if qual else 150
+
+
+def read_blocks(infq):
+    for number in itertools.count():
+        lines = list(itertools.islice(infq, 4 * block_records))
+        if not lines:
+            return
+        if not lines[-1].endswith(b"\n"):
+            lines[-1] += b"\n"
+        heads = lines[0::4] if umi else None
+        quals = lines[3::4] if qual else None
+        yield (number, (lines[1::4], heads, quals))
+
+
+# The "umi<tab>sequence" keys of a block's reads.
+
+def umi_keys(heads, seqs):
+    return [head[1:-1][umi] + b"\t" + sq for head, sq in zip(heads, seqs)]
+
+
+def key_sequence(key):
+    if umi:
+        return key[key.index(b"\t") + 1:]
+    return key
+
+
+def shard_name(scratch, s):
+    return os.path.join(scratch, "shard-" + str(s))
+
+
+# The running counts of one process, by sequence or key, and the
+# quality sums. The counts keep their keys in first occurrence order,
+# and blocks records the rank of the first key new in each block,
+# which with the block numbers orders keys across processes too.
+
+class SequenceCounts:
+
+    def __init__(self, name, budget, scratch):
+        self.name = name
+        self.budget = budget
+        self.scratch = scratch
+        self.counts = Counter()
+        self.quals = {}
+        self.blocks = []
+        self.spilled = False
+
+    def add(self, number, block):
+        seqs, heads, quals = block
+        keys = umi_keys(heads, seqs) if umi else seqs
+        self.blocks.append((len(self.counts), number))
+        self.counts.update(keys)
+        if qual == "mean":
+            sums = self.quals
+            for key, q in zip(keys, map(sum, quals)):
+                sums[key] = sums.get(key, 0) + q
+        elif qual == "max":
+            sums = self.quals
+            for key, q in zip(keys, map(sum, quals)):
+                if q > sums.get(key, 0):
+                    sums[key] = q
+        entry_size = entry_overhead + sum(map(len, seqs)) // len(seqs)
+        if len(self.counts) * entry_size > self.budget:
+            self.spill()
+
+    # Shard files have a "first<tab>count<tab>quality<tab>key" line per
+    # key, the key keeping the sequence's newline. Each process appends
+    # to its own file of each shard.
+
+    def spill(self):
+        spills = [open(shard_name(self.scratch, s) + "-" + self.name, "ab")
+                  for s in range(shards)]
+        items = iter(self.counts.items())
+        bounds = self.blocks + [(len(self.counts), None)]
+        for (start, number), (end, _) in zip(bounds, bounds[1:]):
+            first = number << 32
+            for rank, (key, cnt) in zip(range(start, end), items):
+                spills[hash(key_sequence(key)) % shards].write(
+                    b"%d\t%d\t%d\t%s" % (first + rank, cnt, self.quals.get(key, 0), key))
+        for spill in spills:
+            spill.close()
+        self.counts = Counter()
+        self.quals = {}
+        self.blocks = []
+        self.spilled = True
+
+
+def count_worker(w, blocks, scratch):
+    counts = SequenceCounts(str(w), budget // jobs, scratch)
+    for number, block in iter(blocks.get, None):
+        counts.add(number, block)
+    counts.spill()
+
+
+# Hands block to worker w, giving up if the worker has died rather
+# than waiting on its queue forever.
+
+def put_block(workers, queues, w, block):
     while True:
-        fqrec = read_fqrec(infq)
-        if fqrec == []:
-            break
-        sq = fqrec[1]
-        if sq in sqM:
-            sqM[sq] = sqM[sq] + 1
+        try:
+            queues[w].put(block, timeout=1)
+            return
+        except queue.Full:
+            if not workers[w].is_alive():
+                workers_failed(workers, queues)
+
+
+# A worker has died: the others, still waiting on their queues for
+# blocks that will never come, are terminated, and the queues' feeder
+# threads are not waited on, so that exiting doesn't hang on either.
+
+def workers_failed(workers, queues):
+    for worker in workers:
+        worker.terminate()
+    for blocks in queues:
+        blocks.cancel_join_thread()
+    sys.exit("Collapse worker failed")
+
+
+# Orders (first, count, phred, sequence) entries for the fasta.
+
+def output_key(entry):
+    if order == "count":
+        return (-entry[1], entry[0])
+    return entry[0]
+
+
+# The phred of a sequence from its quality sum over reads reads (for
+# -qual mean) or from its best read's (for -qual max). Quality lines
+# end in a newline, which is in the sums.
+
+def phred(sq, reads, q):
+    length = len(sq) - 1
+    if not qual or length == 0:
+        return 0
+    if qual == "mean":
+        return round((q - 10 * reads) / (reads * length) - 33)
+    return round((q - 10) / length - 33)
+
+
+# Turns (first, count, quality, key) entries into (first, count,
+# phred, sequence) ones in output order, a sequence's count being the
+# number of its UMIs with -umi.
+
+def sequence_entries(keys):
+    seqs = {}
+    for first, cnt, q, key in keys:
+        sq = key_sequence(key)
+        entry = seqs.get(sq)
+        if entry is None:
+            seqs[sq] = [first, 1 if umi else cnt, cnt, q]
         else:
-            sqM[sq] = 1
-    infq.close()
-    i = 1
-    for sq,cnt in sqM.items():
-        hd = ">" + str(i) + "-" + str(cnt) + "\n"
-        otfa.write(hd)
-        otfa.write(sq)
-        i = i + 1
+            entry[0] = min(entry[0], first)
+            entry[1] += 1
+            entry[2] += cnt
+            entry[3] = max(entry[3], q) if qual == "max" else entry[3] + q
+    entries = [(first, count, phred(sq, reads, q), sq)
+               for sq, (first, count, reads, q) in seqs.items()]
+    entries.sort(key=output_key)
+    return entries
+
+
+# Merges the files of one shard, writing its sequences in output order
+# to the shard's ".merged" file.
+
+def merge_shard(scratch, s):
+    name = shard_name(scratch, s)
+    counts = {}
+    for spill in glob.glob(name + "-*"):
+        for first, cnt, q, key in read_shard(spill):
+            entry = counts.get(key)
+            if entry is None:
+                counts[key] = [first, cnt, q]
+            else:
+                entry[0] = min(entry[0], first)
+                entry[1] += cnt
+                entry[2] = max(entry[2], q) if qual == "max" else entry[2] + q
+        os.remove(spill)
+    entries = sequence_entries((first, cnt, q, key) for key, (first, cnt, q) in counts.items())
+    with open(name + ".merged", "wb") as merged:
+        for entry in entries:
+            merged.write(b"%d\t%d\t%d\t%s" % entry)
+    return name + ".merged"
+
+
+def read_shard(name):
+    with open(name, "rb") as shard:
+        for line in shard:
+            first, cnt, q, key = line.split(b"\t", 3)
+            yield (int(first), int(cnt), int(q), key)
+
+
+# The collapsed sequences, as (count, phred, sequence) in output order.
+
+def collapse(infq, scratch):
+    if jobs == 1:
+        counts = SequenceCounts("0", budget, scratch)
+        for number, block in read_blocks(infq):
+            counts.add(number, block)
+        if not counts.spilled:
+            if umi or qual:
+                entries = sequence_entries((first, cnt, counts.quals.get(key, 0), key)
+                                           for first, (key, cnt) in enumerate(counts.counts.items()))
+                return ((cnt, q, sq) for first, cnt, q, sq in entries)
+            if order == "count":
+                return ((cnt, 0, sq) for sq, cnt in counts.counts.most_common())
+            return ((cnt, 0, sq) for sq, cnt in counts.counts.items())
+        counts.spill()
+        merged = [merge_shard(scratch, s) for s in range(shards)]
+    else:
+        context = multiprocessing.get_context("fork")
+        queues = [context.Queue(2) for _ in range(jobs)]
+        workers = [context.Process(target=count_worker, args=(w, queues[w], scratch))
+                   for w in range(jobs)]
+        for worker in workers:
+            worker.start()
+        for number, block in read_blocks(infq):
+            put_block(workers, queues, number % jobs, (number, block))
+        for w in range(jobs):
+            put_block(workers, queues, w, None)
+        for worker in workers:
+            worker.join()
+            if worker.exitcode != 0:
+                workers_failed(workers, queues)
+        with ProcessPoolExecutor(jobs, mp_context=context) as pool:
+            merged = list(pool.map(merge_shard, [scratch] * shards, range(shards)))
+    entries = heapq.merge(*[read_shard(name) for name in merged], key=output_key)
+    return ((cnt, q, sq) for first, cnt, q, sq in entries)
+
+
+# The fastq is read as bytes and records are never decoded, the
+# sequences staying bytes through to the fasta. A compressed fastq is
+# decompressed by -unzip: pigz or gzip run as a subprocess piping into
+# this one - pigz decompressing on threads of its own - or the python
+# gzip module, behind a large buffer so lines are split in C. Returns
+# the input and the subprocess, if any.
+
+gzip_tools = ["pigz", "gzip", "python"]
+
+def gzip_tool(flag, tool):
+    if not tool:
+        tool = next(t for t in gzip_tools if t == "python" or shutil.which(t))
+    if tool not in gzip_tools:
+        sys.exit("Unknown " + flag + ": " + tool)
+    return tool
+
+
+def open_fastq():
+    if arguments.fq:
+        return (open(arguments.fq, "rb", buffering=1024*1024), None)
+    tool = gzip_tool("-unzip", arguments.unzip)
+    if tool == "python":
+        return (io.BufferedReader(gzip.open(arguments.fqz, "rb"), 1024*1024), None)
+    unzip = subprocess.Popen([tool, "-dc", arguments.fqz],
+                             stdout=subprocess.PIPE, bufsize=1024*1024)
+    return (unzip.stdout, unzip)
+
+
+# A fasta named *.gz is compressed the same ways, by -zip: pigz or
+# gzip reading from a pipe - pigz compressing on all cores - or the
+# python gzip module. Returns the output and the subprocess, if any.
 
+def open_fasta():
+    if not arguments.fa.endswith(".gz"):
+        return (open(arguments.fa, "wb", buffering=1024*1024), None)
+    tool = gzip_tool("-zip", arguments.zip)
+    if tool == "python":
+        return (io.BufferedWriter(gzip.open(arguments.fa, "wb", compresslevel=6), 1024*1024), None)
+    with open(arguments.fa, "wb") as fa:
+        gzipper = subprocess.Popen([tool, "-c", "-6"], stdin=subprocess.PIPE,
+                                   stdout=fa, bufsize=1024*1024)
+    return (gzipper.stdin, gzipper)
 
 
+infq, unzip = open_fastq()
+otfa, gzipper = open_fasta()
+scratch = tempfile.mkdtemp(prefix=".collapse-", dir=scratch_dir)
+try:
+    with infq, otfa:
+        i = 1
+        for cnt, q, sq in collapse(infq, scratch):
+            if qual:
+                hd = b">%d-%d-%d\n" % (i, cnt, q)
+            else:
+                hd = b">%d-%d\n" % (i, cnt)
+            otfa.write(hd)
+            otfa.write(sq)
+            i = i + 1
+        if unzip is not None and unzip.wait() != 0:
+            sys.exit("Decompressing " + arguments.fqz + " failed")
+    if gzipper is not None and gzipper.wait() != 0:
+        sys.exit("Compressing " + arguments.fa + " failed")
+finally:
+    shutil.rmtree(scratch, ignore_errors=True)
@@ -14,17 +14,15 @@
 #(setq python-indent-offset 4)
 
 
-import re
 import sys
-import csv
-import glob
-import math
 import argparse
 import datetime
-import os.path
 
-from fitness import fitness
-from normalize import normalize
+from mapfile import read_mapfile
+from reference import load_reference
+from runner import output_files, add_counts, run_references
+from batch import run_batch
+from output import result_formats
 
 ##### ARGUMENTS #####
 
@@ -33,9 +31,9 @@ def print_usage():
     print ("\033[1m" + "Required" + "\033[0m" + "\n")
     print ("-ref" + "\t\t" + "The name of the reference genome file, in GTF/GFF format." + "\n")
     print ("-features" + "\t" + "The feature types to use, defaults to 'CDS', can be comma separted string: 'gene,CDS' etc.")
-    print ("-t1" + "\t\t" + "The name of the bowtie mapfile from time 1." + "\n")
-    print ("-t2" + "\t\t" + "The name of the bowtie mapfile from time 2." + "\n")
-    print ("-out" + "\t\t" + "Name of a file to enter the .csv output." + "\n")
+    print ("-t1" + "\t\t" + "The name of the bowtie mapfile from time 1, or of its .sam/.bam alignments (reads named i-count)." + "\n")
+    print ("-t2" + "\t\t" + "The name of the bowtie mapfile from time 2, or of its .sam/.bam alignments (reads named i-count)." + "\n")
+    print ("-out" + "\t\t" + "Name of a file to enter the .csv output (gzipped if it ends in .gz)." + "\n")
     print ("\n")
     print ("\033[1m" + "Optional" + "\033[0m" + "\n")
     print ("-expansion" + "\t" + "Expansion factor (default: 250)" + "\n")
@@ -52,8 +50,13 @@ def print_usage():
     print ("-multiply" + "\t" + "Multiply all fitness scores by a certain value (e.g., the fitness of a knockout). You should normalize the data." + "\n")
     print ("-ef" + "\t\t" + "Exclude insertions that occur in the first N amount (%) of gene--becuase may not affect gene function." + "\n")
     print ("-el" + "\t\t" + "Exclude insertions in the last N amount (%) of the gene--considering truncation may not affect gene function." + "\n")
-    print ("-wig" + "\t\t" + "Create a wiggle file for viewing in a genome browser. Provide a filename." + "\n")
+    print ("-wig" + "\t\t" + "Create a wiggle file for viewing in a genome browser. Provide a filename (gzipped if it ends in .gz)." + "\n")
     print ("-uncol" + "\t\t" + "Use if reads were uncollapsed when mapped." + "\n")
+    print ("-engine" + "\t\t" + "Fitness engine, 'python' (default) or 'numpy' for the vectorized one (requires numpy)." + "\n")
+    print ("-jobs" + "\t\t" + "Number of worker processes to spread the references over (default 1)." + "\n")
+    print ("-batch" + "\t\t" + "Run every comparison of a manifest file, one 't1 t2 out expansion [ref [normalize [out2]]]' per line," + "\n\t\t" + "in place of -t1/-t2/-out. References and map files shared by comparisons are parsed once." + "\n")
+    print ("-format" + "\t\t" + "Comma separated formats for the results: csv (default), npz (requires numpy), parquet (requires pyarrow)." + "\n\t\t" + "npz and parquet files are named after -out, with their own extension." + "\n")
+    print ("-nocache" + "\t" + "Don't read or write the <mapfile>.sites and <ref>.features caches of parsed maps and references." + "\n")
     print ("\n")
 
 parser = argparse.ArgumentParser()
@@ -78,9 +81,15 @@ parser.add_argument("-ef", action="store", dest="exclude_first")
 parser.add_argument("-el", action="store", dest="exclude_last")
 parser.add_argument("-wig", action="store", dest="wig")
 parser.add_argument("-uncol", action="store", dest="uncol")
+parser.add_argument("-engine", action="store", dest="engine")
+parser.add_argument("-jobs", action="store", dest="jobs")
+parser.add_argument("-batch", action="store", dest="batch")
+parser.add_argument("-nocache", action="store", dest="nocache")
+parser.add_argument("-format", action="store", dest="format")
 arguments = parser.parse_args()
 
-if (not arguments.ref_genome or not arguments.mapfile1 or not arguments.mapfile2 or not arguments.outfile):
+if (not arguments.batch and
+    (not arguments.ref_genome or not arguments.mapfile1 or not arguments.mapfile2 or not arguments.outfile)):
     print_usage()
     quit()
 
@@ -123,282 +132,102 @@ if (not arguments.cutoff2):
 if (not arguments.usestrand):
     arguments.usestrand = "both"
 
+# The scalar python engine is the default; the numpy one computes the
+# same rows in bulk and is only imported when asked for.
 
+if (not arguments.engine):
+    arguments.engine = "python"
 
+if arguments.engine not in ("python", "numpy"):
+    sys.exit("Unknown fitness engine: " + arguments.engine)
 
-##### PARSING THE REFERENCE GENOME #####
+# References are processed one after another unless -jobs asks for
+# more worker processes.
 
-def get_time():
-    return datetime.datetime.now().time()
+if (not arguments.jobs):
+    arguments.jobs = 1
 
+# Results are written as csv unless -format asks for (or also for) the
+# columnar binary formats.
 
-def appendDictVal (d, k, v):
-    if k in d:
-        if 'feats' in d[k]:
-            d[k]['feats'].append(v)
-        else:
-            d[k] = {'feats': [v]}
-    else:
-        d[k] = {'feats': [v]}
+if (not arguments.format):
+    arguments.format = "csv"
+arguments.format = arguments.format.split(',')
 
+for kind in arguments.format:
+    if kind not in result_formats:
+        sys.exit("Unknown results format: " + kind)
 
-print ("\n" + "Starting: " + str(get_time()) + "\n")
-
-# Makes a dictionary out of each feature that's a gene - with its gene
-# name, start location, end location, and strand as keys to their
-# values. Then appends those dictionaries to the list associated with
-# the refname for accessing later on.
-
-def genome_length (refname,gtf):
-    refdir = os.path.dirname(os.path.abspath(gtf.name))
-    with open(glob.glob(os.path.join(refdir, refname) + "*.gbk")[0]) as fp:
-        return float(fp.readline().split()[2])
-
-main_strand = "+"
-if (arguments.reversed):
-    main_strand = "-"
-
-featureset = dict(zip(arguments.features,arguments.features))
-gtf_dict = {}
-
-with open(arguments.ref_genome, 'r') as gtf:
-    ##with open('NZ_CP1204_1205_522_523.gtf', 'r') as gtf:
-    keys = ["kind", "start", "end", "strand", "gene"]
-    for rec in csv.reader(gtf, delimiter='\t'):
-        values = []
-        if rec[2] in featureset:
-            attrs = rec[8]
-            loctag = re.sub('"', "", re.split(" +", re.split("; ", attrs)[0])[1])
-            refname = rec[0]
-            values.append(rec[2])
-            start = float(rec[3])
-            end = float(rec[4])
-            strand = rec[6]
-
-            # Exclude_first and exclude_last are used here to exclude
-            # whatever percentage of the genes you like from
-            # calculations; e.g. a value of 0.1 for exclude_last would
-            # exclude the last 10% of all genes!  This can be useful
-            # because insertions at the very start or end of genes
-            # often don't actually break its function.
-            if strand == "+":
-                if (arguments.exclude_first):
-                    start += (end - start) * float(arguments.exclude_first)
-                if (arguments.exclude_last):
-                    end -= (end - start) * float(arguments.exclude_last)
-            else: # reverse strand - end with first and start with last
-                if (arguments.exclude_first):
-                    end -= (end - start) * float(arguments.exclude_first)
-                if (arguments.exclude_last):
-                    start += (end - start) * float(arguments.exclude_last)
-
-            values.append(start)
-            values.append(end)
-            values.append(strand)
-            values.append(loctag)
-            d = dict(zip(keys, values))
-            appendDictVal(gtf_dict, refname, d)
-            if 'size' not in gtf_dict[refname]:
-                gtf_dict[refname]['size'] = genome_length(refname,gtf)
-
-
-outfile = arguments.outfile
-outfile2 = arguments.outfile2
-outwigfile = "/no/wigfile/wig.csv"
-if (arguments.wig): outwigfile = arguments.wig
 
-for k in gtf_dict:
-    if len(gtf_dict) == 1:
-        gtf_dict[k]['outfile'] = outfile
-        gtf_dict[k]['outfile2'] = outfile2
-        gtf_dict[k]['wigfile'] = outwigfile
-    else:
-        dnm = os.path.dirname(outfile)
-        fnm = os.path.basename(outfile)
-        fnm2 = os.path.basename(outfile2)
-        wfnm = os.path.basename(outwigfile)
-        gtf_dict[k]['outfile'] = os.path.join(dnm, k + '-' + fnm)
-        gtf_dict[k]['outfile2'] = os.path.join(dnm, k + '-' + fnm2)
-        gtf_dict[k]['wigfile'] = os.path.join(dnm, k + '-' + wfnm)
 
 
-print ("Done generating feature lookup: " + str(get_time()) + "\n")
-
+##### PARSING THE REFERENCE GENOME #####
 
+def get_time():
+    return datetime.datetime.now().time()
 
 
-##### PARSING THE MAPFILES #####
+print ("\n" + "Starting: " + str(get_time()) + "\n")
 
 if (arguments.uncol):
     sys.exit("This script must use collapsed map input!!")
 
+# In batch mode every comparison of the manifest is run, and the exit
+# status is the number of comparisons that failed.
+
+if (arguments.batch):
+    failed = run_batch(arguments.batch, arguments)
+    print ("Finished batch: " + str(get_time()) + "\n")
+    sys.exit(min(failed, 125))
+
+gtf_dict = load_reference(arguments.ref_genome, arguments)
+
+outwigfile = "/no/wigfile/wig.csv"
+if (arguments.wig): outwigfile = arguments.wig
+output_files(gtf_dict, arguments.outfile, arguments.outfile2, outwigfile)
+
+print ("Done generating feature lookup: " + str(get_time()) + "\n")
+
 
-# When called, goes through each line of the mapfile to find the
-# strand (+/Watson or -/Crick), count, and position of the read. It
-# may be helpful to look at how the mapfiles are formatted to
-# understand how this code finds them.
-
-def read_mapfile(reads, refname):
-    plus_total = 0
-    minus_total = 0
-    plus_counts = {"total": 0, "sites": 0}
-    minus_counts = {"total": 0, "sites": 0}
-    for read in reads:
-        if (arguments.uncol):
-            sys.exit("Not supposed to happen!")
-
-        elif (refname != read.split()[4]):
-            continue
-
-        else:
-            count = float(read.split()[0])
-            strand = read.split()[1]
-            position = float(read.split()[2])
-
-            # If for some reason you want to skip all reads from one
-            # of the strands - for example, if you wanted to compare
-            # the two strands - that's done here.
-
-            if arguments.usestrand != "both" and strand != arguments.usestrand:
-                continue
-
-            # Makes dictionaries for the + & - strands, with each
-            # insert position as a key and the number of insertions
-            # there as its corresponding value.
-
-            if (strand == main_strand):
-                sequence_length = float(read.split()[3])
-
-                if arguments.downstream:
-                    position += 0
-                # The -2 in "(sequence_length -2)" comes from a
-                # fake "TA" in the read; see how the libraries are
-                # constructed for further on this
-                else:
-                    position += (sequence_length - 2)
-
-                plus_counts["total"] += count
-                plus_counts["sites"] += 1
-                if position in plus_counts:
-                    plus_counts[position] += count
-                else:
-                    plus_counts[position] = count
-            else:
-                minus_counts["total"] += count
-                minus_counts["sites"] += 1
-                if position in minus_counts:
-                    minus_counts[position] += count
-                else:
-                    minus_counts[position] = count
-    print ("Map Counts: " + str(len(plus_counts)) + " " + str(len(minus_counts)))
-    #print "Map elts: " + str(plus_counts.items()[1:10])
-    #print "Map 147: "  + str(plus_counts.get(147, -1)) + " " + str(minus_counts.get(147, -1))
-    return (plus_counts, minus_counts)
 
 
+##### PARSING THE MAPFILES #####
 
 print ("args.downstream : " + str(arguments.downstream))
 
 
-with open(arguments.mapfile1) as file:
-    r1 = file.readlines()
-with open(arguments.mapfile2) as file:
-    r2 = file.readlines()
+# Calls read_mapfile() to parse arguments.mapfile1 and
+# arguments.mapfile2 (your reads from t1 and t2), each in a single
+# pass covering all the references.
 
-# Calls read_mapfile(reads) to parse arguments.reads1 and
-# arguments.reads2 (your reads from t1 and t2).
+maps1 = read_mapfile(arguments.mapfile1, gtf_dict, arguments)
+print ("Read first file: " + str(get_time()) + "\n")
 
-for refname, dict in gtf_dict.items():
-    print ("    >>>> ", refname)
+maps2 = read_mapfile(arguments.mapfile2, gtf_dict, arguments)
+print ("Read second file: " + str(get_time()) + "\n")
 
-    (plus_ref_1, minus_ref_1) = read_mapfile(r1, refname)
-    print ("Read first file: " + str(get_time()) + "\n")
+add_counts(gtf_dict, maps1, maps2, arguments)
 
-    (plus_ref_2, minus_ref_2) = read_mapfile(r2, refname)
-    print ("Read second file: " + str(get_time()) + "\n")
+# The lines below are just printed for reference. The number of sites
+# is the number of reads counted, kept with the counts of each strand.
 
-    dict['pmrefs'] = {'pr1': plus_ref_1, 'mr1': minus_ref_1,
-                      'pr2': plus_ref_2, 'mr2': minus_ref_2}
+for refname in gtf_dict:
+    (plus_ref_1, minus_ref_1) = maps1[refname]
+    (plus_ref_2, minus_ref_2) = maps2[refname]
+    print ("Reads " + refname + ":" + "\n")
+    print ("1: + " + str(plus_ref_1.total) + " - " + str(minus_ref_1.total) + "\n")
+    print ("2: + " + str(plus_ref_2.total) + " - " + str(minus_ref_2.total) + "\n")
+    print ("Sites " + refname + ":" + "\n")
+    print ("1: + " + str(plus_ref_1.sites) + " - " + str(minus_ref_1.sites) + "\n")
+    print ("2: + " + str(plus_ref_2.sites) + " - " + str(minus_ref_2.sites) + "\n")
 
-    # If reads1 and reads2 weren't specified in the command line, sets
-    # them as the total number of reads (found in read_mapfile())
-    if not arguments.reads1:
-        dict['reads1'] = plus_ref_1["total"] + minus_ref_1["total"]
-    else:
-        dict['reads1'] = arguments.reads1
 
-    if not arguments.reads2:
-        dict['reads2'] = plus_ref_2["total"] + minus_ref_2["total"]
-    else:
-        dict['reads2'] = arguments.reads2
 
 
+# Runs the fitness calculations, normalization and output for each
+# reference, over -jobs worker processes if asked for.
 
-# The lines below are just printed for reference. The number of sites
-# is the length of a given dictionary of sites - 1 because its last
-# key, "total", isn't actually a site.
-
-print ("Reads:" + "\n")
-print ("1: + " + str(plus_ref_1["total"]) + " - " + str(minus_ref_1["total"]) + "\n")
-print ("2: + " + str(plus_ref_2["total"]) + " - " + str(minus_ref_2["total"]) + "\n")
-print ("Sites:" + "\n")
-print ("1: + " + str(plus_ref_1["sites"]) + " - " + str(minus_ref_1["sites"]) + "\n")
-print ("2: + " + str(plus_ref_2["sites"]) + " - " + str(minus_ref_2["sites"]) + "\n")
-
-
-
-
-wigp = False
-if (arguments.wig): wigp = True
-
-normgene_file = arguments.normalize
-
-# If making a WIG file is requested in the arguments, starts a string
-# to be added to and then written to the WIG file with a typical WIG
-# file header.  The header is just in a typical WIG file format; if
-# you'd like to look into this more UCSC has notes on formatting WIG
-# files on their site.
-
-for refname, dict in gtf_dict.items():
-    reads1 = dict['reads1']
-    reads2 = dict['reads2']
-    total = float((reads1 + reads2)/2.0)
-
-    if (total == 0):
-        continue
-
-    wigstring = "track type=wiggle_0 name=" + dict['wigfile'] + "\n" + "variableStep chrom=" + refname + "\n"
-
-    print ('********** Reference: ', refname)
-    results,genic,total_inserts = fitness(dict['size'], dict['feats'],
-                                          reads1, reads2,
-                                          dict['pmrefs'], arguments)
-
-    print ("Genic: " + str(genic) + "\n")
-    print ("Total: " + str(total_inserts) + "\n")
-
-    if (arguments.normalize):
-        results, wigstring = normalize(wigp, wigstring, results,
-                                       normgene_file, dict['outfile2'],
-                                       total, refname, arguments)
-        if wigp:
-            with open(dict['wigfile'], "w") as wigfile:
-                wigfile.write(wigstring)
-
-    elif wigp:
-        for list in results:
-            wigstring += str(list[0]) + " " + str(list[11]) + "\n"
-        with open(dict['wigfile'], "w") as wigfile:
-            wigfile.write(wigstring)
-
-    csvfname = dict['outfile']
-    if sys.version_info[0] > 2:
-        csvfile = open(csvfname, 'w', newline='')
-    else:
-        csvfile = open(csvfname, 'wb')
-    writer = csv.writer(csvfile)
-    writer.writerows(results)
-    csvfile.close()
+run_references(gtf_dict, arguments, int(arguments.jobs))
 
 
 
@@ -0,0 +1,162 @@
+##### BATCH COMPARISONS #####
+
+
+# Runs many t1/t2 comparisons in a single calc_fitness invocation
+# (-batch), so that a whole experiment pays for startup, reference
+# parsing and map parsing once rather than once per comparison. The
+# manifest has one comparison per line, with whitespace separated
+# fields:
+#
+#     t1 t2 out expansion [ref [normalize [out2]]]
+#
+# which are the -t1, -t2, -out, -expansion, -ref, -normalize and -out2
+# of that comparison. ref and normalize default to the ones given on
+# the command line, out2 defaults to out with its extension replaced
+# by "-norm-info.txt" and, if -wig is given, the wiggle file is out
+# with its extension replaced by ".wig". Blank lines and lines
+# starting with '#' are skipped. All other flags apply to every
+# comparison.
+#
+# Each reference (GTF) and each map file is parsed once, however many
+# comparisons share it, and the comparisons are then run over a pool
+# of -jobs worker processes. A comparison whose files can't be loaded
+# fails on its own.
+
+import sys
+import argparse
+import os.path
+
+from mapfile import read_mapfile
+from reference import load_reference
+from runner import output_files, add_counts, run_references, worker_pool
+
+
+def read_manifest (manifest, arguments):
+    comparisons = []
+    with open(manifest) as fp:
+        for line in fp:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) < 4:
+                sys.exit("Bad manifest line, need t1 t2 out expansion: " + line)
+
+            (t1, t2, out, expansion) = fields[0:4]
+            ref = fields[4] if len(fields) > 4 else arguments.ref_genome
+            norm = fields[5] if len(fields) > 5 else arguments.normalize
+            stem = os.path.splitext(out)[0]
+            out2 = fields[6] if len(fields) > 6 else stem + "-norm-info.txt"
+            if not ref:
+                sys.exit("No reference for comparison: " + line)
+
+            comparisons.append({'t1': t1, 't2': t2, 'out': out, 'out2': out2,
+                                'wig': stem + ".wig",
+                                'expansion': expansion, 'ref': ref,
+                                'normalize': norm})
+    return comparisons
+
+
+# The arguments of one comparison: the command line ones with its own
+# expansion factor and normalization genes.
+
+def comparison_arguments (comparison, arguments):
+    cmpargs = argparse.Namespace(**vars(arguments))
+    cmpargs.expansion_factor = comparison['expansion']
+    cmpargs.normalize = comparison['normalize']
+    return cmpargs
+
+
+def run_comparison (comparison, gtf_dict, arguments):
+    print ("========== Comparison: ", comparison['t1'], comparison['t2'])
+    run_references(gtf_dict, arguments)
+
+
+# Loads key into cache, once, with load(). A load that failed is
+# remembered too and raised again for every comparison that needs it,
+# so a bad file is neither parsed twice nor stops the other
+# comparisons. SystemExit is caught as well, as reading a map file
+# exits when samtools fails on it.
+
+def cached (cache, key, load):
+    if key not in cache:
+        try:
+            cache[key] = load()
+        except (Exception, SystemExit) as e:
+            cache[key] = e
+    if isinstance(cache[key], BaseException):
+        raise cache[key]
+    return cache[key]
+
+
+# Each comparison gets its own copy of the per reference dictionaries -
+# the features, index and counts are shared, the output names and read
+# totals are its own.
+
+def prepare_comparison (comparison, references, maps, arguments):
+    ref = comparison['ref']
+    reference = cached(references, ref,
+                       lambda: load_reference(ref, arguments))
+    def counts (mapfile):
+        return cached(maps, (mapfile, ref),
+                      lambda: read_mapfile(mapfile, reference, arguments))
+    maps1 = counts(comparison['t1'])
+    maps2 = counts(comparison['t2'])
+
+    cmpargs = comparison_arguments(comparison, arguments)
+    gtf_dict = {}
+    for refname, d in reference.items():
+        gtf_dict[refname] = {'table': d['table'], 'size': d['size'],
+                             'index': d['index']}
+    outwigfile = "/no/wigfile/wig.csv"
+    if (arguments.wig): outwigfile = comparison['wig']
+    output_files(gtf_dict, comparison['out'], comparison['out2'],
+                 outwigfile)
+    add_counts(gtf_dict, maps1, maps2, cmpargs)
+    return (comparison, gtf_dict, cmpargs)
+
+
+def run_batch (manifest, arguments):
+    comparisons = read_manifest(manifest, arguments)
+
+    # A failed comparison, whether its files couldn't be loaded or its
+    # run failed, is reported and the rest still run; the return value
+    # is the number of failures.
+
+    references = {}
+    maps = {}
+    tasks = []
+    failed = 0
+    for comparison in comparisons:
+        try:
+            tasks.append(prepare_comparison(comparison, references, maps,
+                                            arguments))
+        except (Exception, SystemExit) as e:
+            print ("FAILED: ", comparison['out'], e)
+            failed += 1
+    loaded = lambda cache: sum(not isinstance(v, BaseException)
+                               for v in cache.values())
+    print ("Parsed " + str(loaded(references)) + " references, " +
+           str(loaded(maps)) + " map files for " +
+           str(len(tasks)) + " comparisons" + "\n")
+    if not tasks:
+        return failed
+
+    jobs = int(arguments.jobs)
+    if jobs <= 1:
+        for task in tasks:
+            try:
+                run_comparison(*task)
+            except Exception as e:
+                print ("FAILED: ", task[0]['out'], e)
+                failed += 1
+        return failed
+
+    with worker_pool(min(jobs, len(tasks))) as pool:
+        futures = [pool.submit(run_comparison, *task) for task in tasks]
+        for task, future in zip(tasks, futures):
+            try:
+                future.result()
+            except Exception as e:
+                print ("FAILED: ", task[0]['out'], e)
+                failed += 1
+    return failed
@@ -0,0 +1,30 @@
+##### WRITING CACHE FILES #####
+
+
+import os
+import tempfile
+
+
+# Writes path with write(fp), into a temporary file in the same
+# directory that is then renamed into place, so a concurrent reader
+# never sees a partial file. A directory that isn't writable just
+# means no cache: "Cannot write <what> <path>" is printed and nothing
+# is left behind.
+
+def write_atomic (path, write, what, mode="w"):
+    prefix = os.path.splitext(path)[1] + "-"
+    try:
+        fd, tmpname = tempfile.mkstemp(prefix=prefix,
+                                       dir=os.path.dirname(os.path.abspath(path)))
+    except OSError:
+        print ("Cannot write " + what + " " + path)
+        return
+    try:
+        with os.fdopen(fd, mode) as fp:
+            write(fp)
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, path)
+    except OSError:
+        print ("Cannot write " + what + " " + path)
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
@@ -0,0 +1,97 @@
+##### INSERTION COUNTS #####
+
+
+import bisect
+from array import array
+
+
+# The insertion counts of one strand of one reference: the distinct
+# insertion positions, sorted, in an int32 array, with the number of
+# insertions at each in a parallel float64 array - about 12 bytes per
+# site, against 100+ for a dictionary entry. The total count and
+# number of reads (map lines) go with it as attributes.
+#
+# Lookups by position are binary searches, and it supports enough of
+# the dictionary interface (in, [], get, len, iteration over the
+# positions) for the fitness calculations to use it as they used the
+# dictionaries. numpy can view both arrays without copying.
+
+class SiteCounts:
+
+    __slots__ = ("positions", "counts", "total", "sites")
+
+    def __init__ (self, positions=None, counts=None, total=0, sites=0):
+        self.positions = array('i') if positions is None else positions
+        self.counts = array('d') if counts is None else counts
+        self.total = total
+        self.sites = sites
+
+    # Freezes a {position: count} dictionary accumulated while
+    # parsing.
+
+    @classmethod
+    def from_dict (cls, site_counts, total, sites):
+        positions = array('i', sorted(site_counts))
+        counts = array('d', [site_counts[p] for p in positions])
+        return cls(positions, counts, total, sites)
+
+    def __len__ (self):
+        return len(self.positions)
+
+    def __iter__ (self):
+        return iter(self.positions)
+
+    # Index of position in the arrays, or -1 when there were no
+    # insertions there.
+
+    def index (self, position):
+        k = bisect.bisect_left(self.positions, position)
+        if k < len(self.positions) and self.positions[k] == position:
+            return k
+        return -1
+
+    def __contains__ (self, position):
+        return self.index(position) >= 0
+
+    def __getitem__ (self, position):
+        k = self.index(position)
+        if k < 0:
+            raise KeyError(position)
+        return self.counts[k]
+
+    def get (self, position, default=None):
+        k = self.index(position)
+        if k < 0:
+            return default
+        return self.counts[k]
+
+    # Combines two sets of counts, e.g. the plus and minus strands, in
+    # one sweep over both sorted position arrays; counts at positions
+    # present in both are summed.
+
+    def merge (self, other):
+        pa, ca = self.positions, self.counts
+        pb, cb = other.positions, other.counts
+        positions = array('i')
+        counts = array('d')
+        i = j = 0
+        while i < len(pa) and j < len(pb):
+            if pa[i] < pb[j]:
+                positions.append(pa[i])
+                counts.append(ca[i])
+                i += 1
+            elif pb[j] < pa[i]:
+                positions.append(pb[j])
+                counts.append(cb[j])
+                j += 1
+            else:
+                positions.append(pa[i])
+                counts.append(ca[i] + cb[j])
+                i += 1
+                j += 1
+        positions.extend(pa[i:])
+        counts.extend(ca[i:])
+        positions.extend(pb[j:])
+        counts.extend(cb[j:])
+        return SiteCounts(positions, counts,
+                          self.total + other.total, self.sites + other.sites)
@@ -0,0 +1,60 @@
+##### FEATURE LOOKUP #####
+
+
+import bisect
+
+
+# An index over the (possibly overlapping) features of one reference,
+# given as parallel sequences of their starts, ends and gene names,
+# answering "which gene does this insertion fall in" by binary search
+# instead of a linear scan of every feature.
+#
+# The start and end points of all features split the reference into
+# elementary units: each distinct boundary point, and the open gap
+# between each pair of neighbouring points. Every unit is covered by
+# exactly the same set of features, so each one is labelled, when the
+# index is built, with the first feature in GTF order covering it -
+# which keeps the original "first matching feature wins" behavior when
+# features overlap. Labelling walks the features in order and paints
+# only still unlabelled units, using skip pointers so each unit is
+# visited once.
+
+class FeatureIndex:
+
+    def __init__ (self, starts, ends, genes):
+        self.points = sorted(set(starts) | set(ends))
+
+        # Unit 2k is the point self.points[k], unit 2k+1 the gap after it
+        nunits = 2 * len(self.points) + 1
+        self.genes = [None] * nunits
+        skip = list(range(nunits + 1))
+
+        def next_free (u):
+            root = u
+            while skip[root] != root:
+                root = skip[root]
+            while skip[u] != root:
+                skip[u], u = root, skip[u]
+            return root
+
+        for start, end, gene in zip(starts, ends, genes):
+            if end < start:
+                continue
+            first = 2 * bisect.bisect_left(self.points, start)
+            last = 2 * bisect.bisect_left(self.points, end)
+            u = next_free(first)
+            while u <= last:
+                self.genes[u] = gene
+                skip[u] = u + 1
+                u = next_free(u + 1)
+
+    # Returns the locus tag of the first feature containing position,
+    # or None when the position is intergenic.
+
+    def lookup (self, position):
+        k = bisect.bisect_right(self.points, position) - 1
+        if k < 0:
+            return None
+        if self.points[k] == position:
+            return self.genes[2 * k]
+        return self.genes[2 * k + 1]
@@ -9,8 +9,35 @@
 # to be sequenced so that an unequal amount of reads is produced
 
 import math
+import bisect
 
-def fitness (genomelength, feature_list, reads1, reads2, pmrefs, arguments):
+
+# Columns of the results table, written as the first row of the csv.
+
+result_cols = ["position", "strand", "count_1", "count_2", "ratio",
+               "mt_freq_t1", "mt_freq_t2", "pop_freq_t1", "pop_freq_t2",
+               "gene", "D", "W", "nW"]
+
+
+# Insertions are sparse - typically well under 1% of the genome carries
+# one - so rather than walking every base up to genomelength, only the
+# positions actually observed at t1 are visited: the sorted positions
+# of the plus and minus strand counts merged together, less any
+# falling outside the genome.
+
+def insertion_sites (genomelength, plus_counts, minus_counts):
+    positions = plus_counts.merge(minus_counts).positions
+    lo = bisect.bisect_left(positions, 0)
+    hi = bisect.bisect_left(positions, genomelength)
+    return positions[lo:hi]
+
+
+# Yields the results row of each insertion in turn, so they can be
+# written out as they are produced; the number of genic and of all
+# insertions are counted in tally as it goes.
+
+def fitness (genomelength, feature_index, reads1, reads2, pmrefs, arguments,
+             tally):
 
     total = float((reads1 + reads2)/2.0)
     cfactor1 = reads1/total
@@ -23,52 +50,42 @@ def fitness (genomelength, feature_list, reads1, reads2, pmrefs, arguments):
     plus_ref_2 = pmrefs['pr2']
     minus_ref_2 = pmrefs['mr2']
 
-    cols = ["position", "strand", "count_1", "count_2", "ratio",
-            "mt_freq_t1", "mt_freq_t2", "pop_freq_t1", "pop_freq_t2",
-            "gene", "D", "W", "nW"]
-    results = [cols]
-    genic = 0
-    total_inserts = 0
-    i = 0
-    while i < float(genomelength):
-
-        # At each possible location for an insertion in the genome, counts
-        # the number of actual insertions at t1 and which strand(s) the
-        # corresponding reads came from.
-
-        c1 = 0
-        if i in plus_ref_1:
-            c1 = float(plus_ref_1[i])
-            strand = "+/"
-            if i in minus_ref_1:
-                c1 += float(minus_ref_1[i])
-                strand = "b/"
-        elif i in minus_ref_1:
-            c1 = float(minus_ref_1[i])
-            strand = "-/"
+    for i in insertion_sites(float(genomelength), plus_ref_1, minus_ref_1):
 
-        # If there were no insertions at a certain location at t1 just
-        # continues to the next location; there can't be any comparison to
-        # make between t1 and t2 if there are no t1 insertions!
+        # At each location with an insertion at t1, counts the number
+        # of actual insertions and which strand(s) the corresponding
+        # reads came from. Locations without t1 insertions are never
+        # visited; there can't be any comparison to make between t1
+        # and t2 if there are no t1 insertions!
 
+        p1 = plus_ref_1.get(i)
+        m1 = minus_ref_1.get(i)
+        if p1 is not None:
+            c1 = p1
+            strand = "+/"
+            if m1 is not None:
+                c1 += m1
+                strand = "b/"
         else:
-            i += 1
-            continue
+            c1 = m1
+            strand = "-/"
 
         # At each location where there was an insertion at t1, counts the
         # number of insertions at t2 and which strand(s) the corresponding
         # reads came from.
 
+        p2 = plus_ref_2.get(i)
+        m2 = minus_ref_2.get(i)
         c2 = 0
-        if i in plus_ref_2:
-            c2 = float(plus_ref_2[i])
-            if i in minus_ref_2:
-                c2 += float(minus_ref_2[i])
+        if p2 is not None:
+            c2 = p2
+            if m2 is not None:
+                c2 += m2
                 strand += "b"
             else:
                 strand += "+"
-        elif i in minus_ref_2:
-            c2 = float(minus_ref_2[i])
+        elif m2 is not None:
+            c2 = m2
             strand += "-"
 
         # Corrects with cfactor1 and cfactor2
@@ -86,7 +103,6 @@ def fitness (genomelength, feature_list, reads1, reads2, pmrefs, arguments):
         # calculations.
 
         if (c1 + c2)/2 < float(arguments.cutoff):
-            i+= 1
             continue
 
         # Calculates each insertion's frequency within the populations
@@ -117,13 +133,12 @@ def fitness (genomelength, feature_list, reads1, reads2, pmrefs, arguments):
         # Checks which gene locus the insertion falls within, and
         # records that.
 
-        gene = ''
-        for feature_dictionary in feature_list:
-            if feature_dictionary["start"] <= i and i <= feature_dictionary["end"]:
-                gene = "".join(feature_dictionary["gene"])
-                genic += 1
-                break
-        total_inserts += 1
+        gene = feature_index.lookup(i)
+        if gene is None:
+            gene = ''
+        else:
+            tally['genic'] += 1
+        tally['total_inserts'] += 1
 
         # Writes all relevant information on each insertion and its
         # fitness to a cvs file: the location of the insertion, its
@@ -135,8 +150,4 @@ def fitness (genomelength, feature_list, reads1, reads2, pmrefs, arguments):
                mt_freq_t1, mt_freq_t2, pop_freq_t1, pop_freq_t2,
                gene, arguments.expansion_factor, w, w]
 
-        results.append(row)
-        i += 1
-
-    return (results,genic,total_inserts)
-
+        yield row
@@ -0,0 +1,261 @@
+##### PARSING THE MAPFILES #####
+
+
+import os
+import sys
+import json
+import shutil
+import contextlib
+import subprocess
+from array import array
+
+from counts import SiteCounts
+from cachefile import write_atomic
+
+
+# The alignments the mapfiles are made from can be given directly
+# instead, as SAM or BAM files (by their .sam/.bam extension) of reads
+# from a collapsed fasta, named i-count. Each record is turned into the
+# fields of a mapfile line the way make-maps.clj and newmap2oldmap.py
+# do: the count from the read name, the strand from flag 16, the 0
+# based position from POS and the length of SEQ. Unmapped, secondary
+# and supplementary records are skipped.
+
+def sam_fields (lines):
+    for line in lines:
+        if line.startswith("@"):
+            continue
+        fields = line.split("\t", 10)
+        flag = int(fields[1])
+        if flag & 0x904:
+            continue
+        yield (fields[0].split("-")[1], "-" if flag & 16 else "+",
+               int(fields[3]) - 1, len(fields[9]), fields[2])
+
+
+# BAM is read with pysam when it is installed, and otherwise through
+# samtools view.
+
+def bam_fields (mapfile):
+    try:
+        import pysam
+    except ImportError:
+        pysam = None
+
+    if pysam is not None:
+        with pysam.AlignmentFile(mapfile, "rb", check_sq=False) as bam:
+            for read in bam.fetch(until_eof=True):
+                if read.flag & 0x904:
+                    continue
+                yield (read.query_name.split("-")[1],
+                       "-" if read.is_reverse else "+",
+                       read.reference_start, read.query_length,
+                       read.reference_name)
+        return
+
+    if shutil.which("samtools") is None:
+        sys.exit("Reading " + mapfile + " needs pysam or samtools")
+    view = subprocess.Popen(["samtools", "view", mapfile], stdout=subprocess.PIPE,
+                            text=True, bufsize=1024*1024)
+    with view.stdout:
+        yield from sam_fields(view.stdout)
+    if view.wait() != 0:
+        sys.exit("samtools view " + mapfile + " failed")
+
+
+# Opens mapfile, returning the fields of each of its reads and what to
+# close when done with them.
+
+def open_mapfile (mapfile):
+    if mapfile.endswith(".bam"):
+        fields = bam_fields(mapfile)
+        return (fields, contextlib.closing(fields))
+    reads = open(mapfile)
+    if mapfile.endswith(".sam"):
+        return (sam_fields(reads), reads)
+    return (map(str.split, reads), reads)
+
+
+# Goes through each line of the mapfile once to find the count, strand
+# (+/Watson or -/Crick), position and length of the read, and which
+# reference it mapped to. It may be helpful to look at how the
+# mapfiles are formatted to understand how this code finds them.
+#
+# Lines are streamed, not read in whole, and each one is split just
+# once; its counts go straight into the buckets of its reference. So a
+# single pass over the file serves every reference, and memory grows
+# with the number of distinct insertion sites rather than the number
+# of lines. Returns a dictionary of refname to (plus_counts,
+# minus_counts) SiteCounts, for the references in refnames or, when
+# refnames is None, for every reference in the file.
+
+def parse_mapfile (mapfile, arguments, refnames=None):
+
+    # While parsing, each strand is tallied as [position -> count
+    # dictionary, total count, number of reads].
+
+    buckets = {}
+    if refnames is not None:
+        for refname in refnames:
+            buckets[refname] = ([{}, 0, 0], [{}, 0, 0])
+
+    main_strand = "+"
+    if (arguments.reversed):
+        main_strand = "-"
+
+    usestrand = arguments.usestrand
+    downstream = arguments.downstream
+
+    (reads, closer) = open_mapfile(mapfile)
+    with closer:
+        for fields in reads:
+            if not fields:
+                continue
+
+            bucket = buckets.get(fields[4])
+            if bucket is None:
+                if refnames is not None:
+                    continue
+                bucket = buckets[fields[4]] = ([{}, 0, 0], [{}, 0, 0])
+
+            count = float(fields[0])
+            strand = fields[1]
+            position = int(fields[2])
+
+            # If for some reason you want to skip all reads from one
+            # of the strands - for example, if you wanted to compare
+            # the two strands - that's done here.
+
+            if usestrand != "both" and strand != usestrand:
+                continue
+
+            # Tallies the + & - strands separately, with each insert
+            # position as a key and the number of insertions there as
+            # its corresponding value.
+
+            if (strand == main_strand):
+                tally = bucket[0]
+
+                # The -2 in "(sequence_length -2)" comes from a fake
+                # "TA" in the read; see how the libraries are
+                # constructed for further on this
+                if not downstream:
+                    position += (int(fields[3]) - 2)
+            else:
+                tally = bucket[1]
+
+            site_counts = tally[0]
+            site_counts[position] = site_counts.get(position, 0) + count
+            tally[1] += count
+            tally[2] += 1
+
+    maps = {}
+    for refname, (plus, minus) in buckets.items():
+        maps[refname] = (SiteCounts.from_dict(*plus),
+                         SiteCounts.from_dict(*minus))
+    return maps
+
+
+
+##### MAPFILE CACHE #####
+
+# The parsed counts of a mapfile are saved in a binary sidecar file,
+# <mapfile>.sites, and later runs load that instead of parsing the
+# mapfile again - the t1 libraries in particular are used by many
+# comparisons. The sidecar is only used while the mapfile's size and
+# modification time, and the flags changing how it is parsed, are the
+# ones it was written with; otherwise it is rewritten.
+#
+# Format: a magic line, a one line JSON header describing the
+# references, then for each reference the plus strand positions
+# (int32) and counts (float64) and the minus strand ones, as raw
+# arrays in the header's byte order. Loading reads each array straight
+# into place.
+
+sidecar_magic = b"MCSITES1\n"
+
+
+def sidecar_key (mapfile, arguments):
+    st = os.stat(mapfile)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns,
+            "reversed": bool(arguments.reversed),
+            "downstream": bool(arguments.downstream),
+            "usestrand": arguments.usestrand,
+            "byteorder": sys.byteorder}
+
+
+def load_sidecar (mapfile, arguments):
+    sidecar = mapfile + ".sites"
+    try:
+        with open(sidecar, "rb") as fp:
+            if fp.readline() != sidecar_magic:
+                return None
+            header = json.loads(fp.readline())
+            if header["key"] != sidecar_key(mapfile, arguments):
+                return None
+            maps = {}
+            for ref in header["refs"]:
+                strands = []
+                for (n, total, sites) in (ref["plus"], ref["minus"]):
+                    positions = array('i')
+                    positions.fromfile(fp, n)
+                    counts = array('d')
+                    counts.fromfile(fp, n)
+                    strands.append(SiteCounts(positions, counts, total, sites))
+                maps[ref["name"]] = tuple(strands)
+            return maps
+    except (OSError, EOFError, ValueError, KeyError):
+        return None
+
+
+# Written with write_atomic, so a concurrent reader never sees a
+# partial sidecar. key is the sidecar_key taken before the mapfile was
+# parsed, so a mapfile changed while it was being parsed doesn't get a
+# sidecar that looks current.
+
+def write_sidecar (mapfile, maps, key):
+    refs = []
+    for refname, (plus, minus) in maps.items():
+        refs.append({"name": refname,
+                     "plus": [len(plus), plus.total, plus.sites],
+                     "minus": [len(minus), minus.total, minus.sites]})
+    header = {"key": key, "refs": refs}
+
+    def write (fp):
+        fp.write(sidecar_magic)
+        fp.write(json.dumps(header).encode() + b"\n")
+        for (plus, minus) in maps.values():
+            for counts in (plus, minus):
+                counts.positions.tofile(fp)
+                counts.counts.tofile(fp)
+
+    write_atomic(mapfile + ".sites", write, "map cache", "wb")
+
+
+# Returns a dictionary of refname to (plus_counts, minus_counts) for
+# each reference in refnames, from the sidecar cache if it is current
+# and otherwise by parsing the mapfile (and, unless -nocache was
+# given, caching the result for next time). References without any
+# reads in the mapfile get empty counts.
+
+def read_mapfile (mapfile, refnames, arguments):
+    if arguments.nocache:
+        maps = parse_mapfile(mapfile, arguments, refnames)
+    else:
+        maps = load_sidecar(mapfile, arguments)
+        if maps is None:
+            key = sidecar_key(mapfile, arguments)
+            maps = parse_mapfile(mapfile, arguments)
+            write_sidecar(mapfile, maps, key)
+        else:
+            print ("Loaded map cache " + mapfile + ".sites")
+
+    selected = {}
+    for refname in refnames:
+        if refname in maps:
+            (plus_counts, minus_counts) = maps[refname]
+        else:
+            (plus_counts, minus_counts) = (SiteCounts(), SiteCounts())
+        print ("Map Counts: " + refname + " " + str(len(plus_counts)) + " " + str(len(minus_counts)))
+        selected[refname] = (plus_counts, minus_counts)
+    return selected
@@ -1,92 +1,114 @@
 ##### NORMALIZATION #####
 
 
-def normalize (wigp, wigstring, results, normgene_file, outfile2, total, refname, arguments):
+import os
+import csv
+import tempfile
+import os.path
+
+from output import ResultWriter, ResultsWriter
+
+
+# Normalizing needs the norm gene rows of the whole table before any
+# nW can be written, so the rows are streamed once into a csv spool
+# file next to outfile, with nW still equal to W, collecting just the
+# norm gene rows on the way. The spool is then streamed into the
+# results files with the normalized nW, and into the wig file if there
+# is one. Either way only the norm gene rows are held in
+# memory. Floats read back from the spool are exactly the ones
+# written, so the results are the same as normalizing in memory.
+
+def spool_name (outfile):
+    fd, spool = tempfile.mkstemp(prefix=".spool-", suffix=".csv",
+                                 dir=os.path.dirname(os.path.abspath(outfile)))
+    os.close(fd)
+    return spool
+
+
+def read_spool (spool):
+    with open(spool, newline='', buffering=1024*1024) as fp:
+        reader = csv.reader(fp)
+        next(reader)
+        for rec in reader:
+            yield rec
+
+
+def normalize (rows, wig, outfile, normgene_file, outfile2, total, refname, arguments):
 
     # Takes normalization genes (which should all be predicted or known to
     # have fitness values of exactly 1.0, like transposons for example)
     # and uses them to normalize the fitnesses of all insertion locations
     with open(normgene_file) as file:
-        transposon_genes = file.read().splitlines()
+        transposon_genes = set(file.read().splitlines())
+    transposon_genes.discard('')
     print ("Normalize genes loaded" + "\n")
 
-    blank_ws = 0
+    cutoff2 = float(arguments.cutoff2)
+    max_weight = float(arguments.max_weight)
+
+    # Collects the insertions in normalization genes in a single pass:
+    # (gene, score, c1, c2) for each one, with the running sum and
+    # count of their scores. Genes are looked up in a set.
+
     sum = 0
     count = 0
-    weights = []
-    scores = []
-    for list in results:
-        if list[9] != '' and list[9] in transposon_genes: # and list[11]:
-            c1 = list[2]
-            c2 = list[3]
-            score = list[11]
-            avg = (c1 + c2)/2
-
-            # Skips over those insertion locations with too few
-            # insertions - their fitness values are less accurate
-            # because they're based on such small insertion numbers.
-
-            if float(c1) >= float(arguments.cutoff2):
-
-                # Sets a max weight, to prevent insertion location
-                # scores with huge weights from unbalancing the
-                # normalization.
-
-                if (avg >= float(arguments.max_weight)):
-                    avg = float(arguments.max_weight)
-
-                # Tallies how many w values are 0 within the
-                # blank_ws value; you might get many transposon
-                # genes with a w value of 0 if a bottleneck
-                # occurs, for example, which is especially common
-                # with in vivo experiments. This is used later by
-                # aggregate.py For example, when studying a nasal
-                # infection in a mouse model, what bacteria
-                # "sticks" and is able to survive and what
-                # bacteria is swallowed and killed or otherwise
-                # flushed out tends to be a matter of chance not
-                # fitness; all mutants with an insertion in a
-                # specific transposon gene could be flushed out by
-                # chance!
-
-                if score == 0:
-                    blank_ws += 1
-
-                sum += score
-                count += 1
-                weights.append(avg)
-                scores.append(score)
-
-                ##print str(list[9]) + " " + str(score) + " " + str(c1)
-
-    # Counts and removes all "blank" fitness values of normalization
+    normals = []
+    spool = spool_name(outfile)
+    with ResultWriter(spool) as spoolfile:
+        for list in rows:
+            spoolfile.write(list)
+            if list[9] in transposon_genes:
+                c1 = list[2]
+
+                # Skips over those insertion locations with too few
+                # insertions - their fitness values are less accurate
+                # because they're based on such small insertion
+                # numbers.
+
+                if float(c1) >= cutoff2:
+                    score = list[11]
+                    sum += score
+                    count += 1
+                    normals.append((list[9], score, c1, list[3]))
+
+    # Counts and leaves out all "blank" fitness values of normalization
     # genes - those that = 0 - because they most likely don't really
     # have a fitness value of 0, and you just happened to not get any
-    # reads from that location at t2.
-
-    blank_count = 0
-    original_count = len(scores)
-    curr_count = original_count
-    i = 0
-    print ('original_count:', original_count, 'scores[]:', scores)
-    while i < curr_count:
-        w_value = scores[i]
-        if w_value == 0:
-            blank_count += 1
-            weights.pop(i)
-            scores.pop(i)
-            i -= 1
-            curr_count = len(scores)
-        i += 1
-
-        
+    # reads from that location at t2. You might get many transposon
+    # genes with a w value of 0 if a bottleneck occurs, for example,
+    # which is especially common with in vivo experiments. For example,
+    # when studying a nasal infection in a mouse model, what bacteria
+    # "sticks" and is able to survive and what bacteria is swallowed
+    # and killed or otherwise flushed out tends to be a matter of
+    # chance not fitness; all mutants with an insertion in a specific
+    # transposon gene could be flushed out by chance!
+    #
+    # The rest are weighted by their average count, up to a max
+    # weight, to prevent insertion location scores with huge weights
+    # from unbalancing the normalization.
+
+    scores = []
+    weights = []
+    for (gene, score, c1, c2) in normals:
+        if score != 0:
+            scores.append(score)
+            weights.append(min((c1 + c2)/2, max_weight))
+
+    original_count = len(normals)
+    blank_count = original_count - len(scores)
+    print ('original_count:', original_count, 'scores[]:', [n[1] for n in normals])
+
     # If no normalization genes can pass the cutoff, normalization
-    # cannot occur, so just return the original results
+    # cannot occur, so just keep the original results
     if len(scores) == 0:
         print ('WARNING: The normalization genes do not have enough reads to pass cutoff and/or cutoff2')
         print ('try lowering one or both of those arguments.')
         print ('Returning unnormalized results...')
-        return (results, wigstring)
+        with ResultsWriter(outfile, arguments.format) as out:
+            for list in read_spool(spool):
+                out.write(list)
+        os.remove(spool)
+        return
 
     
     pc_blank_normals = float(blank_count) / float(original_count)
@@ -94,21 +116,16 @@ def normalize (wigp, wigstring, results, normgene_file, outfile2, total, refname
         f.write("# blank out of " + str(original_count) + ": " + str(pc_blank_normals) + "\n")
         f.write("blanks: " + str(pc_blank_normals) + "\n" + "total: " + str(total) + "\n" + "refname: " + refname + "\n")
 
-        for list in results:
-            if list[9] != '' and list[9] in transposon_genes:
-                c1 = list[2]
-                if float(c1) >= float(arguments.cutoff2):
-                    f.write(str(list[9]) + " " + str(list[11]) + " " + str(c1) + "\n")
+        for (gene, score, c1, c2) in normals:
+            f.write(str(gene) + " " + str(score) + " " + str(c1) + "\n")
 
         average = sum / count
-        i = 0
         weighted_sum = 0
         weight_sum = 0
-        while i < len(weights):
-            weighted_sum += weights[i]*scores[i]
-            weight_sum += weights[i]
-            i += 1
-            weighted_average = weighted_sum/weight_sum
+        for weight, score in zip(weights, scores):
+            weighted_sum += weight*score
+            weight_sum += weight
+        weighted_average = weighted_sum/weight_sum
 
         f.write("Normalization step:" + "\n")
         f.write("Regular average: " + str(average) + "\n")
@@ -119,9 +136,8 @@ def normalize (wigp, wigstring, results, normgene_file, outfile2, total, refname
         new_ws = 0
         wcount = 0
 
-        for list in results:
-            if list[11] == 'W':
-                continue
+        out = ResultsWriter(outfile, arguments.format)
+        for list in read_spool(spool):
             new_w = float(list[11])/weighted_average
 
             # Sometimes you want to multiply all the fitness values by
@@ -140,13 +156,15 @@ def normalize (wigp, wigstring, results, normgene_file, outfile2, total, refname
                 wcount += 1
 
             list[12] = new_w
+            out.write(list)
+
+            if wig:
+                wig.write(list[0], new_w)
 
-            if wigp:
-                wigstring += str(list[0]) + " " + str(new_w) + "\n"
+        out.close()
+        os.remove(spool)
 
         old_w_mean = old_ws / wcount
         new_w_mean = new_ws / wcount
         f.write("Old W Average: " + str(old_w_mean) + "\n")
         f.write("New W Average: " + str(new_w_mean) + "\n")
-
-    return (results, wigstring)
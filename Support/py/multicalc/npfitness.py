@@ -0,0 +1,149 @@
+##### VECTORIZED FITNESS CALCULATIONS #####
+
+
+# The same calculation as fitness() in fitness.py, but with the counts
+# of every t1 insertion site loaded into aligned numpy arrays so each
+# column of the results is computed in bulk. Selected with
+# "-engine numpy"; numpy is only needed when this engine is used.
+#
+# Rows are identical to those of the scalar engine, including the
+# integer 0s it writes for count_2/ratio when there are no t2 reads and
+# for W when no fitness could be computed. The only expected
+# difference is in W (and so nW): numpy's log may differ from
+# math.log by at most 1 ulp on some platforms, i.e. a relative
+# difference below 1e-15 in those two columns.
+
+import numpy as np
+
+from fitness import insertion_sites
+
+
+# Count at each position in sites for one strand, along with whether
+# the strand had an entry there at all (which decides the strand
+# label, even for a zero count). Views the SiteCounts arrays in place
+# and aligns them to sites by binary search.
+
+def strand_counts (counts, sites):
+    positions = np.asarray(counts.positions)
+    if len(positions) == 0:
+        return (np.zeros(len(sites), dtype=bool),
+                np.zeros(len(sites), dtype=np.float64))
+    kc = np.minimum(np.searchsorted(positions, sites), len(positions) - 1)
+    present = positions[kc] == sites
+    values = np.where(present, np.asarray(counts.counts)[kc], 0.0)
+    return (present, values)
+
+
+# Strand labels indexed by 4*(t1 code) + (t2 code), where a code is
+# 2*(plus strand present) + (minus strand present).
+
+strand_labels = [s1 + s2
+                 for s1 in ["", "-/", "+/", "b/"]
+                 for s2 in ["", "-", "+", "b"]]
+
+
+# Like fitness(), yields the rows one at a time and counts the genic
+# and all insertions in tally; the columns are converted to python
+# values a chunk of rows at a time.
+
+def fitness_numpy (genomelength, feature_index, reads1, reads2, pmrefs,
+                   arguments, tally, chunk=65536):
+
+    total = float((reads1 + reads2)/2.0)
+    cfactor1 = reads1/total
+    cfactor2 = reads2/total
+    print ("Cfactor 1: " + str(cfactor1) + "\n")
+    print ("Cfactor 2: " + str(cfactor2) + "\n")
+
+    pos = np.asarray(insertion_sites(float(genomelength),
+                                     pmrefs['pr1'], pmrefs['mr1']))
+
+    has_p1, p1 = strand_counts(pmrefs['pr1'], pos)
+    has_m1, m1 = strand_counts(pmrefs['mr1'], pos)
+    has_p2, p2 = strand_counts(pmrefs['pr2'], pos)
+    has_m2, m2 = strand_counts(pmrefs['mr2'], pos)
+
+    code = (8*has_p1 + 4*has_m1 + 2*has_p2 + has_m2).tolist()
+
+    expansion = float(arguments.expansion_factor)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+
+        # Corrects with cfactor1 and cfactor2; sites without t2 reads
+        # keep a count_2 and ratio of 0.
+
+        c2_zero = (p2 + m2) == 0
+        c1 = (p1 + m1) / cfactor1
+        c2 = np.where(c2_zero, 0.0, (p2 + m2) / cfactor2)
+        ratio = np.where(c2_zero, 0.0, c2 / c1)
+
+        # Drops the insertions below the cutoff
+
+        keep = ~((c1 + c2)/2 < float(arguments.cutoff))
+
+        mt_freq_t1 = c1/total
+        mt_freq_t2 = c2/total
+        pop_freq_t1 = 1 - mt_freq_t1
+        pop_freq_t2 = 1 - mt_freq_t2
+
+        # The fitness equation, computed everywhere and then masked
+        # to the sites where the scalar engine gets a value: a zero
+        # divisor, or a log of a non positive number, leaves W at 0
+        # there.
+
+        top_arg = mt_freq_t2*(expansion/mt_freq_t1)
+        bot_arg = pop_freq_t2*(expansion/pop_freq_t1)
+        top_w = np.log(top_arg)
+        bot_w = np.log(bot_arg)
+        w = top_w/bot_w
+        attempted = mt_freq_t2 != 0
+        valid = (attempted & (mt_freq_t1 != 0) & (pop_freq_t1 != 0) &
+                 ~(top_arg <= 0) & ~(bot_arg <= 0) & (bot_w != 0))
+
+    for k in np.flatnonzero(keep & attempted & ~valid):
+        print ("!!!!", "mt_freq_t2:", mt_freq_t2[k], "mt_freq_t1:", mt_freq_t1[k])
+        print ("    ", "pop_freq_t2", pop_freq_t2[k], "pop_freq_t1", pop_freq_t1[k])
+
+    # Checks which gene locus each insertion falls within, using the
+    # same elementary units as FeatureIndex.lookup.
+
+    pos = pos[keep]
+    points = np.array(feature_index.points, dtype=np.float64)
+    k = np.searchsorted(points, pos, side='right') - 1
+    on_point = (k >= 0) & (points[np.maximum(k, 0)] == pos)
+    units = np.where(k < 0, -1, 2*k + 1 - on_point)
+    genes = [None if u < 0 else feature_index.genes[u] for u in units.tolist()]
+    tally['genic'] += sum(1 for g in genes if g is not None)
+    tally['total_inserts'] += len(genes)
+    genes = ['' if g is None else g for g in genes]
+    strands = [strand_labels[c] for c, kp in zip(code, keep.tolist()) if kp]
+
+    c1, c2, ratio = c1[keep], c2[keep], ratio[keep]
+    mt_freq_t1, mt_freq_t2 = mt_freq_t1[keep], mt_freq_t2[keep]
+    pop_freq_t1, pop_freq_t2 = pop_freq_t1[keep], pop_freq_t2[keep]
+    w, c2_zero, valid = w[keep], c2_zero[keep], valid[keep]
+
+    # Converts back to python values column by column, restoring the
+    # integer 0s of the scalar engine, and assembles the rows.
+
+    def column (values, lo, hi, zero=None):
+        values = values[lo:hi].astype(object)
+        if zero is not None:
+            values[zero[lo:hi]] = 0
+        return values.tolist()
+
+    for lo in range(0, len(pos), chunk):
+        hi = lo + chunk
+        ws = column(w, lo, hi, ~valid)
+        for row in zip(pos[lo:hi].tolist(),
+                       strands[lo:hi],
+                       column(c1, lo, hi),
+                       column(c2, lo, hi, c2_zero),
+                       column(ratio, lo, hi, c2_zero),
+                       column(mt_freq_t1, lo, hi),
+                       column(mt_freq_t2, lo, hi),
+                       column(pop_freq_t1, lo, hi),
+                       column(pop_freq_t2, lo, hi),
+                       genes[lo:hi],
+                       [arguments.expansion_factor] * len(ws),
+                       ws, ws):
+            yield list(row)
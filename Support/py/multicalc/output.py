@@ -0,0 +1,186 @@
+##### OUTPUT FILES #####
+
+
+# The csv and wiggle outputs are written a row at a time as the rows
+# are produced, through large write buffers, rather than built up in
+# memory and written at the end. A file name ending in ".gz" is gzip
+# compressed on the fly.
+
+import csv
+import gzip
+import os.path
+from array import array
+
+from fitness import result_cols
+
+
+def open_output (fname):
+    if fname.endswith(".gz"):
+        return gzip.open(fname, "wt", newline='', compresslevel=6)
+    return open(fname, "w", newline='', buffering=1024*1024)
+
+
+# The results table: the column header, then one row per insertion.
+
+class ResultWriter:
+
+    def __init__ (self, fname):
+        self.file = open_output(fname)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(result_cols)
+
+    def write (self, row):
+        self.writer.writerow(row)
+
+    def close (self):
+        self.file.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close()
+
+
+# If making a WIG file is requested in the arguments, starts it with a
+# typical WIG file header, then takes a position and value per
+# insertion.  The header is just in a typical WIG file format; if
+# you'd like to look into this more UCSC has notes on formatting WIG
+# files on their site.
+
+class WigWriter:
+
+    def __init__ (self, fname, refname):
+        self.file = open_output(fname)
+        self.file.write("track type=wiggle_0 name=" + fname + "\n" + "variableStep chrom=" + refname + "\n")
+
+    def write (self, position, value):
+        self.file.write(str(position) + " " + str(value) + "\n")
+
+    def close (self):
+        self.file.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close()
+
+
+# The results table can also be written in a typed, columnar binary
+# form - "npz" (numpy) or "parquet" (pyarrow) - which downstream
+# aggregation can load a column at a time without parsing any text.
+# -format takes a comma separated list of the formats to write, e.g.
+# "csv,parquet"; the default is just "csv". The binary files are named
+# after the csv one with its extension replaced.
+#
+# position is int64; strand and gene are categorical (dictionary
+# encoded: int codes plus the list of distinct values, '' being
+# intergenic for gene); the rest are float64. In an npz file the codes
+# of a categorical column c are under c and its values under
+# c_categories.
+
+result_formats = ["csv", "npz", "parquet"]
+
+def columnar_name (outfile, kind):
+    stem = outfile[:-3] if outfile.endswith(".gz") else outfile
+    return os.path.splitext(stem)[0] + "." + kind
+
+
+class ColumnarWriter:
+
+    categorical = (1, 9)
+
+    def __init__ (self, fname, kind):
+        self.fname = fname
+        self.kind = kind
+        self.columns = []
+        self.categories = {}
+        for i in range(len(result_cols)):
+            if i in self.categorical:
+                self.columns.append(array('i'))
+                self.categories[i] = {}
+            elif i == 0:
+                self.columns.append(array('q'))
+            else:
+                self.columns.append(array('d'))
+
+    # Takes rows as the fitness engines produce them, or as read back
+    # from a csv (all strings).
+
+    def write (self, row):
+        for i, value in enumerate(row):
+            if i in self.categorical:
+                codes = self.categories[i]
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(codes)
+                self.columns[i].append(code)
+            elif i == 0:
+                self.columns[i].append(int(value))
+            else:
+                self.columns[i].append(float(value))
+
+    def close (self):
+        if self.kind == "npz":
+            self.write_npz()
+        else:
+            self.write_parquet()
+
+    def write_npz (self):
+        import numpy as np
+        arrays = {}
+        for i, name in enumerate(result_cols):
+            arrays[name] = np.asarray(self.columns[i])
+            if i in self.categorical:
+                arrays[name + "_categories"] = np.array(list(self.categories[i]), dtype=str)
+        with open(self.fname, "wb") as fp:
+            np.savez_compressed(fp, **arrays)
+
+    def write_parquet (self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        arrays = []
+        for i, name in enumerate(result_cols):
+            if i in self.categorical:
+                arrays.append(pa.DictionaryArray.from_arrays(
+                    pa.array(self.columns[i], type=pa.int32()),
+                    pa.array(list(self.categories[i]), type=pa.string())))
+            else:
+                arrays.append(pa.array(self.columns[i]))
+        pq.write_table(pa.Table.from_arrays(arrays, names=result_cols),
+                       self.fname)
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close()
+
+
+# Writes the results of outfile in each of the requested formats.
+
+class ResultsWriter:
+
+    def __init__ (self, outfile, formats):
+        self.writers = []
+        for kind in formats:
+            if kind == "csv":
+                self.writers.append(ResultWriter(outfile))
+            else:
+                self.writers.append(
+                    ColumnarWriter(columnar_name(outfile, kind), kind))
+
+    def write (self, row):
+        for writer in self.writers:
+            writer.write(row)
+
+    def close (self):
+        for writer in self.writers:
+            writer.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close()
@@ -0,0 +1,166 @@
+##### PARSING THE REFERENCE GENOME #####
+
+
+import re
+import os
+import csv
+import glob
+import json
+import os.path
+from array import array
+
+from features import FeatureIndex
+from cachefile import write_atomic
+
+
+# Genome length of refname, from the LOCUS line of its .gbk file in
+# the GTF's directory. Returns the length and the .gbk path.
+
+def genome_length (refname, gtfpath):
+    refdir = os.path.dirname(os.path.abspath(gtfpath))
+    gbk = glob.glob(os.path.join(refdir, refname) + "*.gbk")[0]
+    return (gbk_length(gbk), gbk)
+
+def gbk_length (gbk):
+    with open(gbk) as fp:
+        return float(fp.readline().split()[2])
+
+
+# Parses the GTF into a columnar feature table for each refname: the
+# kind, start, end, strand and gene name (locus tag) of each feature
+# whose kind is in features, in GTF order, with the starts and ends in
+# float arrays and the strands in a string. Each refname also records
+# its genome length and the .gbk it came from.
+
+def parse_gtf (gtfpath, features):
+    featureset = set(features)
+    tables = {}
+
+    with open(gtfpath, 'r') as gtf:
+        for rec in csv.reader(gtf, delimiter='\t'):
+            if rec[2] in featureset:
+                attrs = rec[8]
+                loctag = re.sub('"', "", re.split(" +", re.split("; ", attrs)[0])[1])
+                refname = rec[0]
+                if refname not in tables:
+                    length, gbk = genome_length(refname, gtfpath)
+                    tables[refname] = {'kind': [], 'start': array('d'),
+                                       'end': array('d'), 'strand': [],
+                                       'gene': [], 'length': length,
+                                       'gbk': gbk}
+                table = tables[refname]
+                table['kind'].append(rec[2])
+                table['start'].append(float(rec[3]))
+                table['end'].append(float(rec[4]))
+                table['strand'].append(rec[6])
+                table['gene'].append(loctag)
+
+    for table in tables.values():
+        table['strand'] = "".join(table['strand'])
+    return tables
+
+
+
+##### REFERENCE CACHE #####
+
+# The parsed feature tables are saved as JSON next to the GTF, in
+# <gtf>.features, and reused while the GTF's size and modification
+# time, and the feature kinds asked for, are the ones they were
+# written with. Genome lengths come from the same file, so the
+# reference directory is not globbed again; a .gbk whose modification
+# time changed is just re-read. The key is taken before the GTF is
+# parsed, so a GTF edited during the parse isn't cached as current.
+
+def cache_key (gtfpath, features):
+    st = os.stat(gtfpath)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns,
+            "features": sorted(set(features))}
+
+
+def load_cache (gtfpath, features):
+    try:
+        with open(gtfpath + ".features") as fp:
+            cached = json.load(fp)
+        if cached["key"] != cache_key(gtfpath, features):
+            return None
+        tables = cached["refs"]
+        for table in tables.values():
+            if os.stat(table['gbk']).st_mtime_ns != table['gbk_mtime_ns']:
+                table['length'] = gbk_length(table['gbk'])
+            table['start'] = array('d', table['start'])
+            table['end'] = array('d', table['end'])
+        return tables
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_cache (gtfpath, tables, key):
+    refs = {}
+    for refname, table in tables.items():
+        refs[refname] = dict(table)
+        refs[refname]['start'] = table['start'].tolist()
+        refs[refname]['end'] = table['end'].tolist()
+        refs[refname]['gbk_mtime_ns'] = os.stat(table['gbk']).st_mtime_ns
+
+    write_atomic(gtfpath + ".features",
+                 lambda fp: json.dump({"key": key, "refs": refs}, fp),
+                 "reference cache")
+
+
+# Exclude_first and exclude_last are used here to exclude whatever
+# percentage of the genes you like from calculations; e.g. a value of
+# 0.1 for exclude_last would exclude the last 10% of all genes!  This
+# can be useful because insertions at the very start or end of genes
+# often don't actually break its function. Trims copies of the start
+# and end columns, a feature at a time, once per reference load, and
+# returns them; the table itself is left untrimmed.
+
+def trim_features (table, exclude_first, exclude_last):
+    ef = float(exclude_first) if exclude_first else 0
+    el = float(exclude_last) if exclude_last else 0
+    starts = array('d', table['start'])
+    ends = array('d', table['end'])
+    for i, strand in enumerate(table['strand']):
+        start = starts[i]
+        end = ends[i]
+        if strand == "+":
+            if ef:
+                start += (end - start) * ef
+            if el:
+                end -= (end - start) * el
+        else: # reverse strand - end with first and start with last
+            if ef:
+                end -= (end - start) * ef
+            if el:
+                start += (end - start) * el
+        starts[i] = start
+        ends[i] = end
+    return (starts, ends)
+
+
+# Loads the reference: a dictionary of refname to its feature table
+# ('table'), genome length ('size') and a FeatureIndex over its
+# trimmed features ('index'), so that gene lookup for each insertion
+# doesn't have to scan the whole feature list. The GTF is only parsed
+# when its cache is missing or out of date, and -nocache skips the
+# cache altogether.
+
+def load_reference (ref_genome, arguments):
+    tables = None
+    if not arguments.nocache:
+        tables = load_cache(ref_genome, arguments.features)
+    if tables is None:
+        key = cache_key(ref_genome, arguments.features)
+        tables = parse_gtf(ref_genome, arguments.features)
+        if not arguments.nocache:
+            write_cache(ref_genome, tables, key)
+    else:
+        print ("Loaded reference cache " + ref_genome + ".features")
+
+    gtf_dict = {}
+    for refname, table in tables.items():
+        starts, ends = trim_features(table, arguments.exclude_first,
+                                     arguments.exclude_last)
+        gtf_dict[refname] = {'table': table, 'size': table['length'],
+                             'index': FeatureIndex(starts, ends, table['gene'])}
+    return gtf_dict
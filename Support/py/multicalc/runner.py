@@ -0,0 +1,136 @@
+##### PER REFERENCE CALCULATIONS #####
+
+
+# Everything done for one reference once the map files are parsed:
+# fitness, optional normalization, and writing the csv and wiggle
+# files. Each reference is independent of the others, so this is also
+# what gets handed to the worker processes when -jobs asks for more
+# than one.
+
+import os.path
+import multiprocessing
+import concurrent.futures
+
+from fitness import fitness, result_cols
+from normalize import normalize
+from output import ResultsWriter, WigWriter
+
+
+def fitness_engine (arguments):
+    if arguments.engine == "numpy":
+        from npfitness import fitness_numpy
+        return fitness_numpy
+    return fitness
+
+
+# Names the output files of each reference. With a single reference
+# they are used as given; otherwise each name is prefixed with the
+# refname.
+
+def output_files (gtf_dict, outfile, outfile2, outwigfile):
+    for k in gtf_dict:
+        if len(gtf_dict) == 1:
+            gtf_dict[k]['outfile'] = outfile
+            gtf_dict[k]['outfile2'] = outfile2
+            gtf_dict[k]['wigfile'] = outwigfile
+        else:
+            dnm = os.path.dirname(outfile)
+            fnm = os.path.basename(outfile)
+            fnm2 = os.path.basename(outfile2)
+            wfnm = os.path.basename(outwigfile)
+            gtf_dict[k]['outfile'] = os.path.join(dnm, k + '-' + fnm)
+            gtf_dict[k]['outfile2'] = os.path.join(dnm, k + '-' + fnm2)
+            gtf_dict[k]['wigfile'] = os.path.join(dnm, k + '-' + wfnm)
+
+
+# Attaches the parsed t1 and t2 counts (from read_mapfile()) to each
+# reference. If reads1 and reads2 weren't specified in the command
+# line, sets them as the total number of reads of the reference.
+
+def add_counts (gtf_dict, maps1, maps2, arguments):
+    for refname, dict in gtf_dict.items():
+        (plus_ref_1, minus_ref_1) = maps1[refname]
+        (plus_ref_2, minus_ref_2) = maps2[refname]
+
+        dict['pmrefs'] = {'pr1': plus_ref_1, 'mr1': minus_ref_1,
+                          'pr2': plus_ref_2, 'mr2': minus_ref_2}
+
+        if not arguments.reads1:
+            dict['reads1'] = plus_ref_1.total + minus_ref_1.total
+        else:
+            dict['reads1'] = arguments.reads1
+
+        if not arguments.reads2:
+            dict['reads2'] = plus_ref_2.total + minus_ref_2.total
+        else:
+            dict['reads2'] = arguments.reads2
+
+
+# Rows are written out as the fitness engine produces them, except
+# when normalizing, which has to see all of them first (see
+# normalize()).
+
+def run_reference (refname, dict, arguments):
+    reads1 = dict['reads1']
+    reads2 = dict['reads2']
+    total = float((reads1 + reads2)/2.0)
+
+    if (total == 0):
+        return
+
+    wig = None
+    if (arguments.wig): wig = WigWriter(dict['wigfile'], refname)
+
+    print ('********** Reference: ', refname)
+    tally = {'genic': 0, 'total_inserts': 0}
+    rows = fitness_engine(arguments)(dict['size'], dict['index'],
+                                     reads1, reads2, dict['pmrefs'],
+                                     arguments, tally)
+
+    if (arguments.normalize):
+        normalize(rows, wig, dict['outfile'], arguments.normalize,
+                  dict['outfile2'], total, refname, arguments)
+    else:
+        if wig:
+            wig.write(result_cols[0], result_cols[11])
+        with ResultsWriter(dict['outfile'], arguments.format) as out:
+            for row in rows:
+                out.write(row)
+                if wig:
+                    wig.write(row[0], row[11])
+
+    if wig:
+        wig.close()
+
+    print ("Genic: " + str(tally['genic']) + "\n")
+    print ("Total: " + str(tally['total_inserts']) + "\n")
+
+
+# A pool of jobs worker processes. Workers are forked where possible,
+# so they never re-run the calc_fitness script itself.
+
+def worker_pool (jobs):
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = None
+    return concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                  mp_context=context)
+
+
+# Runs run_reference for every reference in gtf_dict, over a pool of
+# jobs worker processes when jobs > 1. Each reference writes its own
+# output files, so the results don't depend on the order the workers
+# finish in; any worker failure is raised here.
+
+def run_references (gtf_dict, arguments, jobs=1):
+    if jobs <= 1 or len(gtf_dict) <= 1:
+        for refname, dict in gtf_dict.items():
+            run_reference(refname, dict, arguments)
+        return
+
+    with worker_pool(min(jobs, len(gtf_dict))) as pool:
+        futures = [pool.submit(run_reference, refname, dict, arguments)
+                   for refname, dict in gtf_dict.items()]
+        for future in futures:
+            future.result()
@@ -1,4 +1,4 @@
-
+import sys
 import gzip
 import argparse
 
@@ -6,6 +6,9 @@ import argparse
 parser = argparse.ArgumentParser()
 parser.add_argument("-mapin", action="store", dest="mapin")
 parser.add_argument("-mapot", action="store", dest="mapot")
+parser.add_argument("-format", action="store", dest="format")
+parser.add_argument("-merge", action="store", dest="merge")
+parser.add_argument("-mapq", action="store", dest="mapq")
 arguments = parser.parse_args()
 
 
@@ -13,19 +16,135 @@ def print_usage():
     print("\n" + "You are missing one or more required flags." +"\n\n")
     print("-mapin for bowtie1 output map file.")
     print("-mapot for output map file used as input to fitness.")
+    print("Either may be - for stdin/stdout, to pipe straight from bowtie, and a name ending in .gz is gzipped.")
+    print("-format for the input format: bowtie (the default map output) or sam (bowtie -S).")
+    print("-merge for a window: consecutive reads on the same strand and reference within it are merged into one site.")
+    print("-mapq for the lowest MAPQ kept (sam input only).")
 
 if (not arguments.mapin or not arguments.mapot):
     print_usage()
     quit()
 
+informat = arguments.format or "bowtie"
+if informat not in ("bowtie", "sam"):
+    sys.exit("Unknown -format: " + informat)
+mapq = int(arguments.mapq) if arguments.mapq else 0
+if mapq and informat != "sam":
+    sys.exit("-mapq needs -format sam, bowtie map output has no MAPQ")
+
+
+# Input is read, and output written, a chunk of chunk_bytes worth of
+# lines at a time, as bytes - nothing is decoded.
+
+chunk_bytes = 1024 * 1024
+
+def open_map(name, mode):
+    if name == "-":
+        return sys.stdin.buffer if mode == "r" else sys.stdout.buffer
+    if name.endswith(".gz"):
+        return gzip.open(name, mode + "b", compresslevel=6)
+    return open(name, mode + "b", buffering=chunk_bytes)
+
+
+# Both formats give (count, strand, start, read length, refname)
+# records, the count and start left as the bytes they were read as.
+# The count is the one collapse.py put in the read name, i-count;
+# starts are 0 based.
+
+def bowtie_records(lines):
+    records = []
+    for l in lines:
+        rec = l.split(b"\t", 5)
+        records.append((rec[0].split(b"-")[1], # read count
+                        rec[1],                # strand
+                        rec[3],                # start
+                        len(rec[4]),           # read length
+                        rec[2]))               # refname
+    return records
+
+
+# SAM records are those of make-maps.clj: the strand from flag 16, the
+# 1 based POS made 0 based and the length of SEQ. Unmapped (0x4),
+# secondary (0x100) and supplementary (0x800) records are dropped, as
+# calc_fitness does reading SAM itself, so a read reported more than
+# once (bowtie -k/-a) is counted once; so, with -mapq, are ones with a
+# lower MAPQ.
+
+def sam_records(lines):
+    records = []
+    for l in lines:
+        if l.startswith(b"@"):
+            continue
+        rec = l.split(b"\t", 10)
+        flag = int(rec[1])
+        if flag & 0x904 or int(rec[4]) < mapq:
+            continue
+        records.append((rec[0].split(b"-")[1],
+                        b"-" if flag & 16 else b"+",
+                        b"%d" % (int(rec[3]) - 1),
+                        len(rec[9]),
+                        rec[2]))
+    return records
+
+
+# The nearby site merging of make-maps.clj: a read on the same strand
+# and reference as the site before it, and within the window of its
+# position, is merged into it - counts summed, the position the
+# (truncated) mean of the two and the length the longer. The site
+# being merged into carries over from one chunk to the next and is
+# written at the end.
+
+class SiteMerger:
+
+    def __init__(self, window):
+        self.window = window
+        self.site = None
+
+    def merge(self, records):
+        merged = []
+        site = self.site
+        for (cnt, strand, pos, length, refname) in records:
+            cnt = int(cnt)
+            pos = int(pos)
+            if (site is not None and strand == site[1] and refname == site[4]
+                    and abs(pos - site[2]) < self.window):
+                site = (site[0] + cnt, strand, (site[2] + pos) // 2,
+                        max(site[3], length), refname)
+            else:
+                if site is not None:
+                    merged.append(site_record(site))
+                site = (cnt, strand, pos, length, refname)
+        self.site = site
+        return merged
+
+    def flush(self):
+        return [] if self.site is None else [site_record(self.site)]
+
+
+def site_record(site):
+    return (b"%d" % site[0], site[1], b"%d" % site[2], site[3], site[4])
+
+
+def write_records(otmap, records):
+    otmap.write(b"".join([b"%s\t%s\t%s\t%d\t%s\n" % rec for rec in records]))
+
+
+records_of = sam_records if informat == "sam" else bowtie_records
+merger = SiteMerger(int(arguments.merge)) if arguments.merge else None
 
-with open(arguments.mapin, "r") as inmap:
-    with open(arguments.mapot, "w") as otmap:
-        for l in inmap:
-            rec = l.split("\t")
-            lout = "\t".join([rec[0].split("-")[1], # read count
-                              rec[1],               # strand
-                              rec[3],               # start
-                              str(len(rec[4])),     # read length
-                              rec[2]])              # refname
-            otmap.write(lout + "\n")
+inmap = open_map(arguments.mapin, "r")
+otmap = open_map(arguments.mapot, "w")
+try:
+    for lines in iter(lambda: inmap.readlines(chunk_bytes), []):
+        records = records_of(lines)
+        if merger is not None:
+            records = merger.merge(records)
+        write_records(otmap, records)
+    if merger is not None:
+        write_records(otmap, merger.flush())
+finally:
+    otmap.flush()
+    if arguments.mapin != "-":
+        inmap.close()
+    if arguments.mapot != "-":
+        otmap.close()
@@ -0,0 +1,69 @@
+## Startup checks for the aerobio command line client: printing the
+## usage and rejecting bad arguments must not import trio,
+## trio_websocket or msgpack (see import_client in aerobio/__main__.py).
+## The imports are read from -X importtime and are the real check; the
+## wall time is only a coarse guard, under STARTUP_LIMIT seconds
+## (AEROBIO_STARTUP_LIMIT in the environment overrides it, for slow or
+## loaded hosts). Kept outside aerobio/, which is zipped up as is into
+## the client.
+##
+## python -m unittest test_aerobio_startup   (from this directory)
+
+import os
+import sys
+import time
+import tempfile
+import unittest
+import subprocess
+
+HERE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aerobio")
+MAIN = os.path.join(HERE, "__main__.py")
+CLIENT_MODULES = ("trio", "trio_websocket", "msgpack")
+STARTUP_LIMIT = float(os.environ.get("AEROBIO_STARTUP_LIMIT", 2.0))
+
+
+def run_main (*args):
+    start = time.monotonic()
+    proc = subprocess.run([sys.executable, "-X", "importtime", MAIN] + list(args),
+                          cwd=HERE, capture_output=True, text=True)
+    elapsed = time.monotonic() - start
+    imported = set()
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            name = line.rsplit("|", 1)[1].strip()
+            imported.add(name.split(".")[0])
+    return (proc, elapsed, imported)
+
+
+class StartupTest (unittest.TestCase):
+
+    def check_startup (self, *args):
+        proc, elapsed, imported = run_main(*args)
+        for mod in CLIENT_MODULES:
+            self.assertNotIn(mod, imported, "%s imported for %r" % (mod, args))
+        self.assertLess(elapsed, STARTUP_LIMIT)
+        return proc
+
+    def test_usage (self):
+        proc = self.check_startup()
+        self.assertEqual(proc.returncode, 0)
+        self.assertIn("batch", proc.stdout)
+
+    def test_missing_arguments (self):
+        proc = self.check_startup("run")
+        self.assertNotEqual(proc.returncode, 0)
+
+    def test_bad_batch_command (self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as fp:
+            fp.write("check EXP1\nrun phase0\n")
+        try:
+            proc = self.check_startup("batch", fp.name)
+        finally:
+            os.remove(fp.name)
+        self.assertNotEqual(proc.returncode, 0)
+        self.assertIn("Missing arguments in batch command: run phase0",
+                      proc.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()